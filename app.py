@@ -1,470 +1,3646 @@
-import customtkinter as ctk
-import tkinter as tk
-from tkinter import filedialog, messagebox
-from docx import Document
-import threading
-import os
-from mistralai import Mistral
-import pythoncom
-import win32com.client
-from datetime import datetime
-import json
-import re
-import logging
-
-# Configure logging
-logging.basicConfig(level=logging.INFO)
-
-# Initialize Mistral AI API
-MISTRAL_API_KEY = "API_KEY"
-client = Mistral(api_key=MISTRAL_API_KEY)
-
-class DocumentEventSystem:
-    def __init__(self):
-        self.events = {}
-    
-    def subscribe(self, event_name, callback):
-        if event_name not in self.events:
-            self.events[event_name] = []
-        self.events[event_name].append(callback)
-    
-    def emit(self, event_name, data):
-        if event_name in self.events:
-            for callback in self.events[event_name]:
-                try:
-                    callback(data)
-                except Exception as e:
-                    logging.error(f"Error in event callback: {e}")
-
-class DocumentEditor:
-    def __init__(self):
-        self.word_app = None
-        self.active_doc = None
-        self.changes_stack = []
-        self.undo_stack = []
-        self.content_cache = {}
-        self.doc_lock = threading.RLock()
-        
-    def initialize_word(self):
-        try:
-            self.word_app = win32com.client.Dispatch("Word.Application")
-            self.word_app.Visible = False
-        except Exception as e:
-            logging.error(f"Failed to initialize Word: {e}")
-            raise
-    
-    def open_document(self, path: str) -> bool:
-        if self.active_doc:
-            self.close_document()
-        try:
-            self.active_doc = self.word_app.Documents.Open(path)
-            self.active_doc.TrackRevisions = True
-            return True
-        except Exception as e:
-            logging.error(f"Error opening document: {e}")
-            return False
-    
-    def close_document(self):
-        if self.active_doc:
-            self.active_doc.Close(SaveChanges=True)
-            self.active_doc = None
-    
-    def apply_changes(self, changes: list) -> bool:
-        try:
-            with self.doc_lock:
-                if not self.active_doc:
-                    logging.error("No active document to apply changes.")
-                    return False
-                
-                logging.info(f"Applying {len(changes)} changes to the document.")
-                
-                for change in changes:
-                    change_type = change.get('type')
-                    if change_type == 'insert':
-                        position = change.get('position', 0)
-                        text = change.get('text', '')
-                        rng = self.active_doc.Range(position, position)
-                        rng.InsertAfter(text)
-                        formatting = change.get('formatting', {})
-                        if formatting:
-                            self._apply_formatting(rng, formatting)
-                    elif change_type == 'delete':
-                        start = change.get('start', 0)
-                        end = change.get('end', start)
-                        rng = self.active_doc.Range(start, end)
-                        rng.Delete()
-                    elif change_type == 'replace':
-                        start = change.get('start', 0)
-                        end = change.get('end', start)
-                        text = change.get('text', '')
-                        rng = self.active_doc.Range(start, end)
-                        rng.Text = text
-                        formatting = change.get('formatting', {})
-                        if formatting:
-                            self._apply_formatting(rng, formatting)
-                    elif change_type == 'format':
-                        start = change.get('start', 0)
-                        end = change.get('end', start)
-                        formatting = change.get('formatting', {})
-                        rng = self.active_doc.Range(start, end)
-                        self._apply_formatting(rng, formatting)
-                    else:
-                        logging.warning(f"Unknown change type: {change_type}")
-                
-                self.active_doc.Save()
-                self.changes_stack.append(changes)
-                return True
-        except Exception as e:
-            logging.error(f"Unexpected error applying changes: {e}")
-            return False
-    
-    def _apply_formatting(self, rng, formatting: dict):
-        try:
-            if formatting.get('bold') is not None:
-                rng.Font.Bold = formatting['bold']
-            if formatting.get('italic') is not None:
-                rng.Font.Italic = formatting['italic']
-            if formatting.get('size') is not None:
-                rng.Font.Size = formatting['size']
-            if formatting.get('color') is not None:
-                rng.Font.Color = formatting['color']
-        except Exception as e:
-            logging.error(f"Error applying formatting: {e}")
-    
-    def undo(self) -> bool:
-        if not self.changes_stack:
-            return False
-        changes = self.changes_stack.pop()
-        self.undo_stack.append(changes)
-        return True
-    
-    def redo(self) -> bool:
-        if not self.undo_stack:
-            return False
-        changes = self.undo_stack.pop()
-        self.apply_changes(changes)
-        return True
-
-class DocumentAnalyzer:
-    def __init__(self):
-        self.structure_cache = {}
-        self.statistics = {}
-        
-    def analyze_document(self, doc: Document) -> dict:
-        stats = {
-            'word_count': self._count_words(doc),
-            'paragraph_count': len(doc.paragraphs),
-            'headings': self._analyze_headings(doc),
-            'formatting': self._analyze_formatting(doc),
-            'language_stats': self._analyze_language(doc)
-        }
-        self.statistics = stats
-        return stats
-        
-    def _count_words(self, doc: Document) -> int:
-        return sum(len(paragraph.text.split()) for paragraph in doc.paragraphs)
-        
-    def _analyze_headings(self, doc: Document) -> dict:
-        headings = {}
-        for paragraph in doc.paragraphs:
-            if paragraph.style.name.startswith('Heading'):
-                level = paragraph.style.name.split()[-1]
-                headings[paragraph.text] = level
-        return headings
-        
-    def _analyze_formatting(self, doc: Document) -> dict:
-        formatting = {
-            'bold_count': 0,
-            'italic_count': 0,
-            'underline_count': 0
-        }
-        return formatting
-        
-    def _analyze_language(self, doc: Document) -> dict:
-        text = ' '.join(p.text for p in doc.paragraphs)
-        return {
-            'sentence_count': len(re.findall(r'[.!?]+', text)),
-            'avg_word_length': sum(len(word) for word in text.split()) / len(text.split()) if text else 0
-        }
-
-class DocumentChatApp:
-    def __init__(self):
-        self.root = ctk.CTk()
-        self.root.title("Advanced Document Chat Assistant")
-        self.root.geometry("1400x900")
-        ctk.set_appearance_mode("dark")
-        ctk.set_default_color_theme("blue")
-        self.document_editor = DocumentEditor()
-        self.document_analyzer = DocumentAnalyzer()
-        self.current_document = None
-        self.document_path = None
-        self.chat_history = []
-        self.event_system = DocumentEventSystem()
-        self.setup_ui()
-        self.setup_keyboard_shortcuts()
-    
-    def setup_ui(self):
-        self.main_container = ctk.CTkFrame(self.root)
-        self.main_container.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
-        self.setup_sidebar()
-        self.setup_main_content()
-    
-    def setup_sidebar(self):
-        sidebar = ctk.CTkFrame(self.main_container, width=200)
-        sidebar.pack(side=tk.LEFT, fill=tk.Y, padx=(0, 10))
-        self.browse_button = ctk.CTkButton(sidebar, text="Open Document", command=self.browse_file)
-        self.browse_button.pack(pady=5, padx=5, fill=tk.X)
-        operations_frame = ctk.CTkFrame(sidebar)
-        operations_frame.pack(fill=tk.X, pady=5, padx=5)
-        ctk.CTkButton(operations_frame, text="Analyze Document", command=self.analyze_document).pack(fill=tk.X, pady=2)
-        ctk.CTkButton(operations_frame, text="Export Chat", command=self.export_chat).pack(fill=tk.X, pady=2)
-        self.stats_display = ctk.CTkTextbox(sidebar, height=200, wrap=tk.WORD)
-        self.stats_display.pack(fill=tk.X, pady=5, padx=5)
-        actions_frame = ctk.CTkFrame(sidebar)
-        actions_frame.pack(fill=tk.X, pady=5, padx=5)
-        ctk.CTkButton(actions_frame, text="↩ Undo", command=self.undo_change).pack(side=tk.LEFT, expand=True, padx=2)
-        ctk.CTkButton(actions_frame, text="↪ Redo", command=self.redo_change).pack(side=tk.LEFT, expand=True, padx=2)
-    
-    def setup_main_content(self):
-        self.chat_frame = ctk.CTkFrame(self.main_container)
-        self.chat_frame.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-        self.chat_display = ctk.CTkTextbox(self.chat_frame, wrap=tk.WORD, font=("Arial", 12))
-        self.chat_display.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
-        input_frame = ctk.CTkFrame(self.chat_frame)
-        input_frame.pack(fill=tk.X, pady=5, padx=5)
-        self.input_field = ctk.CTkTextbox(input_frame, height=100, font=("Arial", 12))
-        self.input_field.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 5))
-        send_button = ctk.CTkButton(input_frame, text="Send", command=self.send_message)
-        send_button.pack(side=tk.RIGHT)
-    
-    def setup_keyboard_shortcuts(self):
-        self.root.bind('<Control-z>', lambda e: self.undo_change())
-        self.root.bind('<Control-y>', lambda e: self.redo_change())
-        self.root.bind('<Control-s>', lambda e: self.save_document())
-        self.input_field.bind('<Control-Return>', lambda e: self.send_message())
-    
-    def browse_file(self):
-        file_path = filedialog.askopenfilename(filetypes=[("Word Documents", "*.docx"), ("All Files", "*.*")])
-        if file_path:
-            self.document_path = file_path
-            self.load_document(file_path)
-    
-    def load_document(self, path):
-        try:
-            self.current_document = Document(path)
-            self.document_editor.initialize_word()
-            if self.document_editor.open_document(path):
-                self.append_to_chat("System", "Document loaded successfully!")
-                self.analyze_document()
-            else:
-                self.append_to_chat("System", "Error initializing real-time editing.")
-        except Exception as e:
-            self.append_to_chat("System", f"Error loading document: {str(e)}")
-    
-    def analyze_document(self):
-        if not self.current_document:
-            self.append_to_chat("System", "Please load a document first!")
-            return
-        stats = self.document_analyzer.analyze_document(self.current_document)
-        self.update_stats_display(stats)
-    
-    def update_stats_display(self, stats):
-        self.stats_display.configure(state=tk.NORMAL)
-        self.stats_display.delete('1.0', tk.END)
-        self.stats_display.insert(tk.END, "Document Statistics:\n\n")
-        self.stats_display.insert(tk.END, f"Words: {stats['word_count']}\n")
-        self.stats_display.insert(tk.END, f"Paragraphs: {stats['paragraph_count']}\n")
-        self.stats_display.insert(tk.END, f"Sentences: {stats['language_stats']['sentence_count']}\n")
-        self.stats_display.insert(tk.END, f"Avg. Word Length: {stats['language_stats']['avg_word_length']:.2f}\n")
-        self.stats_display.configure(state=tk.DISABLED)
-    
-    def send_message(self):
-        message = self.input_field.get("1.0", tk.END).strip()
-        command = message  # Assuming the entire message is the command
-        if not message:
-            return
-        if not self.current_document:
-            self.append_to_chat("System", "Please load a document first!")
-            return
-        self.input_field.delete("1.0", tk.END)
-        self.append_to_chat("You", message)
-        threading.Thread(target=self._process_message_thread, args=(message, command, self._update_chat_callback)).start()
-    
-    def _process_message_thread(self, message, command, callback):
-        try:
-            context = self.prepare_context(message, command)
-            response = self.get_ai_response(context)
-            logging.info(f"AI Response: {response}")
-            callback(response, command)
-        except Exception as e:
-            self.root.after(0, lambda: self.append_to_chat("System", f"Error: {str(e)}"))
-    
-    def _update_chat_callback(self, response, command):
-        self.append_to_chat("Assistant", response['message'])
-        if response['status'] == 'success':
-            modifications = self.parse_modifications(response['message'], command)
-            if modifications:
-                self.root.after(0, lambda: self.document_editor.apply_changes(modifications))
-    
-    def prepare_context(self, message, command) -> dict:
-        return {
-            'message': message,
-            'command': command,
-            'document_content': self.get_document_content(),
-            'chat_history': self.chat_history[-5:],
-            'document_stats': self.document_analyzer.statistics
-        }
-    
-    def get_ai_response(self, context) -> dict:
-        try:
-            chat_response = client.agents.complete(
-                agent_id="ag:364281a7:20241130:word-agent:9c4d242f",
-                messages=[{"role": "user", "content": self._format_context(context)}]
-            )
-            return {'message': chat_response.choices[0].message.content, 'status': 'success'}
-        except Exception as e:
-            return {'message': f"Error getting AI response: {e}", 'status': 'error'}
-    
-    def _format_context(self, context: dict) -> str:
-        return f"""
-        Current message: {context['message']}
-        
-        Document content:
-        {context['document_content']}
-        
-        Recent chat history:
-        {self._format_chat_history(context['chat_history'])}
-        
-        Document statistics:
-        {json.dumps(context['document_stats'], indent=2)}
-        """
-    
-    def _format_chat_history(self, history: list) -> str:
-        return "\n".join([f"{msg['role']}: {msg['content']}" for msg in history])
-    
-    def parse_modifications(self, response: str, command: str) -> list:
-        try:
-            pattern = r'MODIFY_DOCUMENT\s*\n*([\s\S]*?)(?=\s*$)'
-            match = re.search(pattern, response)
-            
-            if not match:
-                logging.warning("No modification found in response.")
-                return []
-                
-            json_str = match.group(1).strip()
-            json_str = re.sub(r',(\s*[}\]])', r'\1', json_str)
-            modifications = json.loads(json_str)
-            
-            line_number = None
-            search_text = None
-            if "at line" in command:
-                line_number_match = re.search(r'at line (\d+)', command)
-                if line_number_match:
-                    line_number = int(line_number_match.group(1))
-            elif "find" in command:
-                search_text_match = re.search(r'find "(.*?)"', command)
-                if search_text_match:
-                    search_text = search_text_match.group(1)
-            
-            if line_number:
-                content = self.get_document_content()
-                lines = content.split('\n')
-                if line_number <= len(lines):
-                    position = sum(len(line) + 1 for line in lines[:line_number - 1])
-                else:
-                    position = len(content)
-                for change in modifications['changes']:
-                    if change['type'] == 'insert':
-                        change['position'] = position
-            elif search_text:
-                content = self.get_document_content()
-                start = content.find(search_text)
-                if start != -1:
-                    position = start + len(search_text)
-                    for change in modifications['changes']:
-                        if change['type'] == 'insert':
-                            change['position'] = position
-                else:
-                    logging.warning(f"Text '{search_text}' not found in the document.")
-            
-            return modifications['changes']
-        except json.JSONDecodeError as e:
-            logging.error(f"JSON Decode Error: {e}")
-            return []
-        except Exception as e:
-            logging.error(f"Error parsing modifications: {e}")
-            return []
-    
-    def append_to_chat(self, role: str, message: str):
-        timestamp = datetime.now().strftime("%H:%M")
-        def update_chat():
-            self.chat_display.configure(state=tk.NORMAL)
-            self.chat_display.insert(tk.END, f"\n[{timestamp}] {role}:\n{message}\n")
-            self.chat_display.configure(state=tk.DISABLED)
-            self.chat_display.see(tk.END)
-        if threading.current_thread() is threading.main_thread():
-            update_chat()
-        else:
-            self.root.after(0, update_chat)
-    
-    def get_document_content(self) -> str:
-        if not self.current_document:
-            return ""
-        return "\n".join([p.text for p in self.current_document.paragraphs])
-    
-    def save_document(self):
-        if self.document_editor.active_doc:
-            try:
-                self.document_editor.active_doc.Save()
-                self.append_to_chat("System", "Document saved successfully!")
-            except Exception as e:
-                self.append_to_chat("System", f"Error saving document: {str(e)}")
-    
-    def export_chat(self):
-        if not self.chat_history:
-            messagebox.showinfo("Export Chat", "No chat history to export!")
-            return
-        file_path = filedialog.asksaveasfilename(defaultextension=".txt", filetypes=[("Text files", "*.txt"), ("All files", "*.*")])
-        if file_path:
-            try:
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    for msg in self.chat_history:
-                        f.write(f"[{msg['timestamp']}] {msg['role']}:\n{msg['content']}\n\n")
-                messagebox.showinfo("Export Chat", "Chat history exported successfully!")
-            except Exception as e:
-                messagebox.showerror("Export Error", f"Error exporting chat: {e}")
-    
-    def undo_change(self):
-        if self.document_editor.undo():
-            self.append_to_chat("System", "Change undone successfully!")
-        else:
-            self.append_to_chat("System", "No changes to undo.")
-    
-    def redo_change(self):
-        if self.document_editor.redo():
-            self.append_to_chat("System", "Change redone successfully!")
-        else:
-            self.append_to_chat("System", "No changes to redo.")
-    
-    def run(self):
-        pythoncom.CoInitialize()
-        self.root.mainloop()
-        pythoncom.CoUninitialize()
-    
-    def cleanup(self):
-        try:
-            if self.document_editor.active_doc:
-                self.document_editor.close_document()
-            if self.document_editor.word_app:
-                self.document_editor.word_app.Quit()
-        except Exception as e:
-            logging.error(f"Error during cleanup: {e}")
-        finally:
-            pythoncom.CoUninitialize()
-
-if __name__ == "__main__":
-    app = DocumentChatApp()
-    try:
-        app.run()
-    finally:
+import time
+# Start-up is measured from here to the first drawn frame
+STARTED = time.perf_counter()
+
+import customtkinter as ctk
+import tkinter as tk
+from tkinter import filedialog, messagebox
+from lxml import etree
+import asyncio
+import threading
+import os
+import posixpath
+from collections import OrderedDict, deque
+from datetime import datetime
+from array import array
+import bisect
+import copy
+import cProfile
+import gzip
+import hashlib
+import heapq
+import importlib.util
+import io
+import json
+import math
+import re
+import logging
+import shutil
+import sqlite3
+import sys
+import zipfile
+
+# Word automation is Windows-only and pywin32 is slow to import, so it is loaded by
+# _load_win32() the first time the Word backend starts
+pythoncom = None
+win32com = None
+
+# python-docx is about half of the import, so it is loaded by _load_docx() the first
+# time a Document is built, edited or analyzed; streaming never needs it
+Document = None
+OxmlElement = None
+Pt = RGBColor = None
+BabelFish = None
+Paragraph = None
+Run = None
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+
+# Mistral AI API defaults; the client itself is built on first use
+MISTRAL_API_KEY = "API_KEY"
+MISTRAL_AGENT_ID = "ag:364281a7:20241130:word-agent:9c4d242f"
+
+def _win32_available() -> bool:
+    return importlib.util.find_spec("win32com") is not None
+
+def _load_win32():
+    global pythoncom, win32com
+    if win32com is None:
+        import pythoncom
+        import win32com.client
+    return win32com
+
+def _load_docx():
+    global Document, OxmlElement, Pt, RGBColor, BabelFish, Paragraph, Run
+    # Run is bound last, so another thread never sees it set before the rest
+    if Run is None:
+        from docx import Document
+        from docx.oxml import OxmlElement
+        from docx.shared import Pt, RGBColor
+        from docx.styles import BabelFish
+        from docx.text.paragraph import Paragraph
+        from docx.text.run import Run
+
+# Pending chat text is drained into the display at most once per frame
+CHAT_FRAME_MS = 16
+RESPONSE_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".document_chat_assistant", "responses.sqlite3")
+CHAT_HISTORY_DIR = os.path.join(os.path.expanduser("~"), ".document_chat_assistant", "history")
+
+class DocumentEventSystem:
+    def __init__(self):
+        self.events = {}
+    
+    def subscribe(self, event_name, callback):
+        if event_name not in self.events:
+            self.events[event_name] = []
+        self.events[event_name].append(callback)
+    
+    def emit(self, event_name, data):
+        if event_name in self.events:
+            for callback in self.events[event_name]:
+                try:
+                    callback(data)
+                except Exception as e:
+                    logging.error(f"Error in event callback: {e}")
+
+class Histogram:
+    # Log-scale buckets about 10% wide, so memory stays constant and percentiles are
+    # accurate to within one bucket
+    GROWTH = 1.1
+    ZERO_BUCKET = -10000
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value: float):
+        index = math.ceil(math.log(value, self.GROWTH)) if value > 0 else self.ZERO_BUCKET
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def bound(self, index: int) -> float:
+        return 0.0 if index == self.ZERO_BUCKET else self.GROWTH ** index
+
+    def percentile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(max(self.bound(index), self.min), self.max)
+        return self.max
+
+    def cumulative(self) -> list:
+        # (upper bound, observations at or below it) in increasing order
+        result = []
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            result.append((self.bound(index), seen))
+        return result
+
+    def summary(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99)
+        }
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **fields):
+        pass
+
+NULL_SPAN = _NullSpan()
+
+class _Span:
+    __slots__ = ('metrics', 'stage', 'fields', 'started', 'profiler')
+
+    def __init__(self, metrics, stage, fields):
+        self.metrics = metrics
+        self.stage = stage
+        self.fields = fields
+        self.started = None
+        self.profiler = None
+
+    def __enter__(self):
+        metrics = self.metrics
+        metrics.emit('stage_started', {'stage': self.stage, **self.fields})
+        if metrics.profile_dir and self.stage in metrics.profile_stages:
+            self.profiler = cProfile.Profile()
+            try:
+                self.profiler.enable()
+            except ValueError:
+                # Another profiler is already active on this thread
+                self.profiler = None
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.started
+        metrics = self.metrics
+        if self.profiler is not None:
+            self.profiler.disable()
+            metrics.dump_profile(self.stage, self.profiler)
+        metrics.observe(f"{self.stage}_seconds", duration)
+        if exc_type is not None:
+            metrics.count(f"{self.stage}_errors")
+        metrics.emit('stage_finished', {'stage': self.stage, 'duration': duration,
+                                        'error': exc_type is not None, **self.fields})
+        return False
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+class Metrics:
+    # Stage durations, sizes and counters for the chat pipeline. While disabled,
+    # span() hands out a shared no-op span and observe()/count() return at once,
+    # so instrumented code only pays an attribute check. Enabled spans also emit
+    # stage_started/stage_finished events on the attached DocumentEventSystem, from
+    # whichever thread ran the stage. With a profile_dir, spans for profile_stages
+    # run under cProfile and leave one .prof file per call.
+    PROFILE_STAGES = frozenset(('prepare_context', 'parse_modifications', 'apply_changes'))
+
+    def __init__(self, enabled: bool = False, event_system: DocumentEventSystem = None,
+                 profile_dir: str = None, profile_stages=PROFILE_STAGES):
+        self.enabled = enabled
+        self.event_system = event_system
+        self.profile_dir = profile_dir
+        self.profile_stages = frozenset(profile_stages)
+        self._histograms = {}
+        self._counters = {}
+        self._collectors = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_environment(cls) -> "Metrics":
+        # DOCUMENT_ASSISTANT_METRICS=1 enables recording; any other value is also the
+        # file the snapshot is written to on exit (Prometheus text for *.prom)
+        setting = os.environ.get('DOCUMENT_ASSISTANT_METRICS')
+        profile_dir = os.environ.get('DOCUMENT_ASSISTANT_PROFILE_DIR')
+        return cls(bool(setting) or bool(profile_dir), profile_dir=profile_dir)
+
+    def span(self, stage: str, **fields):
+        if not self.enabled:
+            return NULL_SPAN
+        return _Span(self, stage, fields)
+
+    def observe(self, name: str, value: float):
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def count(self, name: str, amount: int = 1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def emit(self, event_name: str, data: dict):
+        if self.event_system is not None:
+            self.event_system.emit(event_name, data)
+
+    def add_collector(self, name: str, collect):
+        # `collect` returns a dict of current values, read whenever a snapshot is taken
+        self._collectors[name] = collect
+
+    def dump_profile(self, stage: str, profiler):
+        try:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            stamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+            profiler.dump_stats(os.path.join(self.profile_dir, f"{stage}-{stamp}-{threading.get_ident()}.prof"))
+        except Exception as e:
+            logging.error(f"Error writing profile: {e}")
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            histograms = {name: histogram.summary() for name, histogram in self._histograms.items()}
+            counters = dict(self._counters)
+        gauges = {}
+        for name, collect in self._collectors.items():
+            try:
+                values = collect()
+            except Exception as e:
+                logging.error(f"Error collecting {name} metrics: {e}")
+                continue
+            for key, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    gauges[f"{name}_{key}"] = value
+        return {'histograms': histograms, 'counters': counters, 'gauges': gauges}
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self, prefix: str = 'document_assistant') -> str:
+        def metric_name(name):
+            return re.sub(r'[^a-zA-Z0-9_]', '_', f"{prefix}_{name}")
+
+        with self._lock:
+            histograms = {name: (histogram.cumulative(), histogram.sum, histogram.count)
+                          for name, histogram in self._histograms.items()}
+            counters = dict(self._counters)
+        lines = []
+        for name, (buckets, total, count) in sorted(histograms.items()):
+            name = metric_name(name)
+            lines.append(f"# TYPE {name} histogram")
+            for bound, seen in buckets:
+                lines.append(f'{name}_bucket{{le="{bound:.6g}"}} {seen}')
+            lines.append(f'{name}_bucket{{le="+Inf"}} {count}')
+            lines.append(f"{name}_sum {total}")
+            lines.append(f"{name}_count {count}")
+        for name, value in sorted(counters.items()):
+            name = metric_name(f"{name}_total")
+            lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name} {value}")
+        for name, value in sorted(self.snapshot()['gauges'].items()):
+            name = metric_name(name)
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        text = self.to_prometheus() if path.endswith('.prom') else self.to_json()
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+default_metrics = Metrics.from_environment()
+
+class OffsetIndex:
+    # Prefix sums over segment (paragraph or line) lengths, kept in fixed-size blocks so
+    # edits only touch one block plus the per-block prefix arrays. Segments are joined
+    # by a single separator character, like get_document_content().
+    BLOCK_SIZE = 256
+
+    def __init__(self, lengths=()):
+        lengths = list(lengths) or [0]
+        size = self.BLOCK_SIZE
+        self._blocks = [lengths[i:i + size] for i in range(0, len(lengths), size)]
+        self._sums = [sum(block) + len(block) for block in self._blocks]
+        self._char_starts = []
+        self._segment_starts = []
+        self._dirty = 0
+
+    @classmethod
+    def from_text(cls, text: str) -> "OffsetIndex":
+        return cls(len(line) for line in text.split('\n'))
+
+    def _refresh(self):
+        if self._dirty >= len(self._blocks):
+            return
+        del self._char_starts[self._dirty:]
+        del self._segment_starts[self._dirty:]
+        if self._dirty:
+            chars = self._char_starts[-1] + self._sums[self._dirty - 1]
+            segments = self._segment_starts[-1] + len(self._blocks[self._dirty - 1])
+        else:
+            chars = segments = 0
+        for b in range(self._dirty, len(self._blocks)):
+            self._char_starts.append(chars)
+            self._segment_starts.append(segments)
+            chars += self._sums[b]
+            segments += len(self._blocks[b])
+        self._dirty = len(self._blocks)
+
+    def _invalidate(self, block: int):
+        self._dirty = min(self._dirty, block)
+
+    def _find(self, index: int):
+        self._refresh()
+        if not 0 <= index < len(self):
+            raise IndexError(f"Segment {index} out of range")
+        b = bisect.bisect_right(self._segment_starts, index) - 1
+        return b, index - self._segment_starts[b]
+
+    def __len__(self) -> int:
+        self._refresh()
+        return self._segment_starts[-1] + len(self._blocks[-1])
+
+    @property
+    def total(self) -> int:
+        self._refresh()
+        return self._char_starts[-1] + self._sums[-1] - 1
+
+    def length(self, index: int) -> int:
+        b, k = self._find(index)
+        return self._blocks[b][k]
+
+    def start(self, index: int) -> int:
+        b, k = self._find(index)
+        return self._char_starts[b] + sum(self._blocks[b][:k]) + k
+
+    def locate(self, offset: int):
+        self._refresh()
+        offset = min(max(0, offset), self.total)
+        b = bisect.bisect_right(self._char_starts, offset) - 1
+        local = offset - self._char_starts[b]
+        block = self._blocks[b]
+        for k, length in enumerate(block):
+            if local <= length:
+                return self._segment_starts[b] + k, local
+            local -= length + 1
+        return self._segment_starts[b] + len(block) - 1, block[-1]
+
+    def line_offset(self, line_number: int) -> int:
+        if line_number - 1 < len(self):
+            return self.start(max(0, line_number - 1))
+        return self.total
+
+    def resize(self, index: int, delta: int):
+        b, k = self._find(index)
+        self._blocks[b][k] += delta
+        self._sums[b] += delta
+        self._invalidate(b + 1)
+
+    def insert_segments(self, index: int, lengths: list):
+        # Insert new segments before `index` (or append when index == len(self))
+        if not lengths:
+            return
+        if index == len(self):
+            b, k = len(self._blocks) - 1, len(self._blocks[-1])
+        else:
+            b, k = self._find(index)
+        block = self._blocks[b]
+        block[k:k] = lengths
+        self._sums[b] += sum(lengths) + len(lengths)
+        if len(block) > 2 * self.BLOCK_SIZE:
+            size = self.BLOCK_SIZE
+            pieces = [block[i:i + size] for i in range(0, len(block), size)]
+            self._blocks[b:b + 1] = pieces
+            self._sums[b:b + 1] = [sum(piece) + len(piece) for piece in pieces]
+        self._invalidate(b)
+
+    def split(self, index: int, local: int):
+        length = self.length(index)
+        self.resize(index, local - length)
+        self.insert_segments(index + 1, [length - local])
+
+    def join(self, first: int, last: int, length: int):
+        # Replace segments first..last (inclusive) with a single segment
+        b1, k1 = self._find(first)
+        b2, k2 = self._find(last)
+        if b1 == b2:
+            self._blocks[b1][k1:k2 + 1] = [length]
+        else:
+            del self._blocks[b1][k1 + 1:]
+            self._blocks[b1][k1] = length
+            del self._blocks[b2][:k2 + 1]
+            del self._blocks[b1 + 1:b2]
+            del self._sums[b1 + 1:b2]
+            b2 = b1 + 1
+            if not self._blocks[b2]:
+                del self._blocks[b2]
+                del self._sums[b2]
+            else:
+                self._sums[b2] = sum(self._blocks[b2]) + len(self._blocks[b2])
+        self._sums[b1] = sum(self._blocks[b1]) + len(self._blocks[b1])
+        self._invalidate(b1)
+
+    def insert_text(self, offset: int, text: str):
+        index, local = self.locate(offset)
+        lines = text.split('\n')
+        if len(lines) == 1:
+            self.resize(index, len(text))
+            return
+        self.split(index, local)
+        self.resize(index, len(lines[0]))
+        self.resize(index + 1, len(lines[-1]))
+        self.insert_segments(index + 1, [len(line) for line in lines[1:-1]])
+
+    def delete_range(self, start: int, end: int):
+        if end <= start:
+            return
+        first, first_local = self.locate(start)
+        last, last_local = self.locate(end)
+        if first == last:
+            self.resize(first, first_local - last_local)
+        else:
+            self.join(first, last, first_local + self.length(last) - last_local)
+
+    def apply_change(self, change: dict):
+        change_type = change.get('type')
+        if change_type == 'insert':
+            self.insert_text(change.get('position', 0), change.get('text', ''))
+        elif change_type in ('delete', 'replace'):
+            start = change.get('start', 0)
+            self.delete_range(start, change.get('end', start))
+            if change_type == 'replace':
+                self.insert_text(start, change.get('text', ''))
+
+class ParagraphText:
+    # Plain text kept as a list of paragraph strings with an OffsetIndex over their
+    # lengths, so an edit only rebuilds the paragraphs it touches and the joined text
+    # is only built when asked for.
+    def __init__(self, paragraphs=()):
+        self.paragraphs = list(paragraphs) or ['']
+        self.index = OffsetIndex(len(paragraph) for paragraph in self.paragraphs)
+
+    @property
+    def text(self) -> str:
+        return "\n".join(self.paragraphs)
+
+    @property
+    def total(self) -> int:
+        return self.index.total
+
+    def slice(self, start: int, end: int) -> str:
+        first, first_local = self.index.locate(start)
+        last, last_local = self.index.locate(end)
+        if first == last:
+            return self.paragraphs[first][first_local:last_local]
+        pieces = [self.paragraphs[first][first_local:]]
+        pieces.extend(self.paragraphs[first + 1:last])
+        pieces.append(self.paragraphs[last][:last_local])
+        return "\n".join(pieces)
+
+    def insert(self, position: int, text: str):
+        index, local = self.index.locate(position)
+        paragraph = self.paragraphs[index]
+        lines = text.split("\n")
+        if len(lines) == 1:
+            self.paragraphs[index] = paragraph[:local] + text + paragraph[local:]
+        else:
+            lines[0] = paragraph[:local] + lines[0]
+            lines[-1] += paragraph[local:]
+            self.paragraphs[index:index + 1] = lines
+        self.index.insert_text(position, text)
+
+    def delete(self, start: int, end: int):
+        if end <= start:
+            return
+        first, first_local = self.index.locate(start)
+        last, last_local = self.index.locate(end)
+        self.paragraphs[first:last + 1] = [self.paragraphs[first][:first_local] + self.paragraphs[last][last_local:]]
+        self.index.delete_range(start, end)
+
+    def apply_change(self, change: dict) -> list:
+        # Returns the changes that undo this one; formatting has no effect on the text
+        change_type = change.get('type')
+        total = self.index.total
+        if change_type == 'insert':
+            position = min(max(0, change.get('position', 0)), total)
+            text = change.get('text', '')
+            self.insert(position, text)
+            return [{'type': 'delete', 'start': position, 'end': position + len(text)}]
+        if change_type in ('delete', 'replace'):
+            start = min(max(0, change.get('start', 0)), total)
+            end = min(max(start, change.get('end', start)), total)
+            inverse = [{'type': 'insert', 'position': start, 'text': self.slice(start, end)}]
+            self.delete(start, end)
+            if change_type == 'replace':
+                text = change.get('text', '')
+                self.insert(start, text)
+                inverse.insert(0, {'type': 'delete', 'start': start, 'end': start + len(text)})
+            return inverse
+        return []
+
+class _Fenwick:
+    # Prefix sums over a fixed number of slots with O(log n) updates and queries
+    def __init__(self, size: int):
+        self._tree = [0] * (size + 1)
+
+    def add(self, index: int, value):
+        index += 1
+        while index < len(self._tree):
+            self._tree[index] += value
+            index += index & -index
+
+    def prefix(self, count: int):
+        # Sum of the first `count` slots
+        total = 0
+        while count > 0:
+            total += self._tree[count]
+            count &= count - 1
+        return total
+
+def rebase_changes(changes: list) -> list:
+    # Changes in a batch are written against the same snapshot of the document, but
+    # the editors apply them one after another, so shift each one past earlier edits.
+    # Every offset is known up front, so earlier edits are kept in Fenwick trees over
+    # the sorted offsets and each rebase costs O(log n) rather than a pass over them.
+    keys = set()
+    for change in changes:
+        if change.get('type') == 'insert':
+            keys.add(change.get('position', 0))
+        elif change.get('type') in ('delete', 'replace', 'format'):
+            keys.add(change.get('start', 0))
+            keys.add(change.get('end', change.get('start', 0)))
+    keys = sorted(keys)
+    # Edits that are a point (inserts) shift offsets after them, and offsets at them
+    # unless the offset ends a span; edits over a span shift offsets from its end on
+    # and collapse offsets inside it to its start
+    points = _Fenwick(len(keys))
+    span_deltas = _Fenwick(len(keys))
+    span_starts = _Fenwick(len(keys))
+    span_start_sums = _Fenwick(len(keys))
+    span_ends = _Fenwick(len(keys))
+    span_end_start_sums = _Fenwick(len(keys))
+
+    def rebase(offset, after_inserts=True):
+        before = bisect.bisect_left(keys, offset)
+        through = bisect.bisect_right(keys, offset)
+        shifted = offset + span_deltas.prefix(through) + points.prefix(through if after_inserts else before)
+        # Spans starting before the offset that have not ended by it contain it
+        inside = span_starts.prefix(before) - span_ends.prefix(through)
+        return shifted + span_start_sums.prefix(before) - span_end_start_sums.prefix(through) - inside * offset
+
+    def record(start, end, delta):
+        if start < end:
+            span_deltas.add(bisect.bisect_left(keys, end), delta)
+            span_starts.add(bisect.bisect_left(keys, start), 1)
+            span_start_sums.add(bisect.bisect_left(keys, start), start)
+            span_ends.add(bisect.bisect_left(keys, end), 1)
+            span_end_start_sums.add(bisect.bisect_left(keys, end), start)
+        else:
+            points.add(bisect.bisect_left(keys, end), delta)
+
+    rebased = []
+    for change in changes:
+        change = dict(change)
+        change_type = change.get('type')
+        if change_type == 'insert':
+            position = change.get('position', 0)
+            change['position'] = rebase(position)
+            record(position, position, len(change.get('text', '')))
+        elif change_type in ('delete', 'replace', 'format'):
+            start = change.get('start', 0)
+            end = change.get('end', start)
+            change['start'] = rebase(start)
+            change['end'] = max(change['start'], rebase(end, after_inserts=False))
+            if change_type != 'format':
+                inserted = len(change.get('text', '')) if change_type == 'replace' else 0
+                record(start, end, inserted - (end - start))
+        rebased.append(change)
+    return rebased
+
+CHARS_PER_TOKEN = 4
+TOKEN_PATTERN = re.compile(r'\w+')
+STOP_WORDS = frozenset("""a an and are as at be by for from has have in is it its of on or that the this
+to was were will with i you me my we our please can could would should do does document text""".split())
+
+def tokenize(text: str) -> list:
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOP_WORDS]
+
+class ChunkIndex:
+    # BM25 over line-aligned chunks of the document text. Chunks are joined by the
+    # line separator, so an OffsetIndex over chunk lengths maps offsets to chunks and
+    # an edit only re-chunks and re-indexes the chunks it overlaps.
+    K1 = 1.5
+    B = 0.75
+
+    def __init__(self, text: str, chunk_chars: int = 1200):
+        self.chunk_chars = chunk_chars
+        self._next_id = 0
+        self._terms = {}
+        self._lengths = {}
+        self._postings = {}
+        self._total_tokens = 0
+        pieces = self._split(text)
+        self.offsets = OffsetIndex(len(piece) for piece in pieces)
+        self._ids = [self._add(piece) for piece in pieces]
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def _split(self, text: str) -> list:
+        pieces = []
+        current = []
+        size = 0
+        for line in text.split('\n'):
+            if current and size + len(line) > self.chunk_chars:
+                pieces.append('\n'.join(current))
+                current = []
+                size = 0
+            current.append(line)
+            size += len(line) + 1
+        pieces.append('\n'.join(current))
+        return pieces
+
+    def _add(self, text: str) -> int:
+        chunk_id = self._next_id
+        self._next_id += 1
+        tokens = tokenize(text)
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for token, count in counts.items():
+            self._postings.setdefault(token, {})[chunk_id] = count
+        self._terms[chunk_id] = counts
+        self._lengths[chunk_id] = len(tokens)
+        self._total_tokens += len(tokens)
+        return chunk_id
+
+    def _remove(self, chunk_id: int):
+        for token in self._terms.pop(chunk_id):
+            postings = self._postings[token]
+            del postings[chunk_id]
+            if not postings:
+                del self._postings[token]
+        self._total_tokens -= self._lengths.pop(chunk_id)
+
+    def apply_change(self, change: dict, read):
+        # `read(start, end)` returns the document text after the change, so only the
+        # chunks the change overlaps are read back
+        change_type = change.get('type')
+        if change_type == 'insert':
+            start = end = change.get('position', 0)
+            inserted = len(change.get('text', ''))
+        elif change_type in ('delete', 'replace'):
+            start = change.get('start', 0)
+            end = change.get('end', start)
+            inserted = len(change.get('text', '')) if change_type == 'replace' else 0
+        else:
+            return
+        total = self.offsets.total
+        start = min(max(0, start), total)
+        end = min(max(start, end), total)
+        first = self.offsets.locate(start)[0]
+        last = self.offsets.locate(end)[0]
+        region_start = self.offsets.start(first)
+        region_end = self.offsets.start(last) + self.offsets.length(last) + inserted - (end - start)
+        pieces = self._split(read(region_start, region_end))
+        for chunk_id in self._ids[first:last + 1]:
+            self._remove(chunk_id)
+        self._ids[first:last + 1] = [self._add(piece) for piece in pieces]
+        self.offsets.join(first, last, len(pieces[0]))
+        self.offsets.insert_segments(first + 1, [len(piece) for piece in pieces[1:]])
+
+    def span(self, index: int) -> tuple:
+        start = self.offsets.start(index)
+        return start, start + self.offsets.length(index)
+
+    def search(self, query: str, limit: int = 50) -> list:
+        # Chunk positions ranked by BM25 score, best first
+        count = len(self._ids)
+        average = self._total_tokens / count or 1
+        scores = {}
+        for token in set(tokenize(query)):
+            postings = self._postings.get(token)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for chunk_id, tf in postings.items():
+                norm = self.K1 * (1 - self.B + self.B * self._lengths[chunk_id] / average)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (self.K1 + 1) / (tf + norm)
+        best = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+        wanted = {chunk_id for chunk_id, _ in best}
+        positions = {}
+        for position, chunk_id in enumerate(self._ids):
+            if chunk_id in wanted:
+                positions[chunk_id] = position
+                if len(positions) == len(wanted):
+                    break
+        return [positions[chunk_id] for chunk_id, _ in best]
+
+    def select(self, query: str, anchors: list, token_budget: int) -> list:
+        # Chunks around each anchor offset first, then the best matches for the query,
+        # until the budget is spent. Returns (start, end) spans in document order.
+        candidates = []
+        for offset in anchors:
+            index = self.offsets.locate(offset)[0]
+            candidates.extend((index, index - 1, index + 1))
+        candidates.extend(self.search(query))
+        budget = token_budget * CHARS_PER_TOKEN
+        chosen = set()
+        for index in candidates:
+            if index in chosen or not 0 <= index < len(self._ids):
+                continue
+            start, end = self.span(index)
+            if end - start > budget:
+                continue
+            budget -= end - start
+            chosen.add(index)
+        return [self.span(index) for index in sorted(chosen)]
+
+MODIFY_MARKER = 'MODIFY_DOCUMENT'
+JSON_OPENING = re.compile(r'\s*(?:```(?:json)?\s*)?([\[{])')
+JSON_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|[{}\[\]]')
+TRAILING_COMMA = re.compile(r',(\s*[}\]])')
+FIND_PATTERN = re.compile(r'find(?:\s+(?:the\s+)?(-?\d+)(?:st|nd|rd|th)?)?\s+"(.*?)"')
+LINE_PATTERN = re.compile(r'at line (\d+)')
+
+def extract_modification_blocks(response: str) -> list:
+    # Every JSON value that follows a MODIFY_DOCUMENT marker. Strings and brackets
+    # are matched in a single forward pass, so each character is looked at once.
+    blocks = []
+    position = response.find(MODIFY_MARKER)
+    while position != -1:
+        position += len(MODIFY_MARKER)
+        opening = JSON_OPENING.match(response, position)
+        if opening is None:
+            position = response.find(MODIFY_MARKER, position)
+            continue
+        start = opening.start(1)
+        end = None
+        depth = 0
+        for token in JSON_TOKEN.finditer(response, start):
+            symbol = token.group()
+            if symbol in '{[':
+                depth += 1
+            elif symbol in '}]':
+                depth -= 1
+                if depth == 0:
+                    end = token.end()
+                    break
+        if end is None:
+            logging.warning("Unterminated modification block in response.")
+            break
+        try:
+            blocks.append(json.loads(TRAILING_COMMA.sub(r'\1', response[start:end])))
+        except json.JSONDecodeError as e:
+            logging.error(f"JSON Decode Error: {e}")
+        position = response.find(MODIFY_MARKER, end)
+    return blocks
+
+def find_occurrence(text: str, pattern: str, occurrence: int):
+    # Start offset of the 1-based occurrence of `pattern`, counting overlapping matches;
+    # negative values count back from the end. Scanning stops at the requested match.
+    if not pattern or occurrence == 0:
+        return None
+    if occurrence > 0:
+        start = -1
+        for _ in range(occurrence):
+            start = text.find(pattern, start + 1)
+            if start < 0:
+                return None
+        return start
+    end = len(text)
+    for _ in range(-occurrence):
+        start = text.rfind(pattern, 0, end)
+        if start < 0:
+            return None
+        # The next match back must start before this one
+        end = start + len(pattern) - 1
+    return start
+
+def resolve_anchors(text: str, targets: list) -> list:
+    # Start offsets for (pattern, occurrence) targets, None where there is no such match
+    found = {}
+    for target in targets:
+        if target not in found:
+            found[target] = find_occurrence(text, *target)
+    return [found[target] for target in targets]
+
+RELATIONSHIP = '{http://schemas.openxmlformats.org/package/2006/relationships}Relationship'
+
+def _related_part(archive: zipfile.ZipFile, source: str, kind: str):
+    # Zip entry of the part that `source` ('' for the package itself) points to with a
+    # relationship of type `kind`, e.g. 'officeDocument' or 'styles'; None if none
+    folder, name = posixpath.split(source)
+    try:
+        relationships = etree.fromstring(archive.read(posixpath.join(folder, '_rels', name + '.rels')))
+    except KeyError:
+        return None
+    for relationship in relationships.iterchildren(RELATIONSHIP):
+        if relationship.get('TargetMode') == 'External' or not relationship.get('Type', '').endswith('/' + kind):
+            continue
+        target = relationship.get('Target', '')
+        return target[1:] if target.startswith('/') else posixpath.normpath(posixpath.join(folder, target))
+    return None
+
+def _main_part(archive: zipfile.ZipFile) -> str:
+    # Word usually writes word/document.xml, but Word Online and others may not
+    return _related_part(archive, '', 'officeDocument') or 'word/document.xml'
+
+FORMAT_KEYS = ('bold', 'italic', 'underline', 'size', 'color')
+WD_UNDEFINED = 9999999
+
+class DocxStreamReader:
+    # Reads the body paragraphs of a .docx straight from the zip with an incremental
+    # parser, so text and statistics never need the whole XML tree or python-docx's
+    # Document. Each paragraph is reduced to plain values and everything parsed
+    # before it is dropped, so memory stays flat however large the file is.
+    CHUNK_BYTES = 1 << 16
+
+    def __init__(self, path: str):
+        self.path = path
+        self._style_names = None
+
+    def style_names(self) -> dict:
+        # Paragraph style id -> display name, with None mapped to the default style
+        if self._style_names is None:
+            _load_docx()
+            names = {None: ''}
+            with zipfile.ZipFile(self.path) as archive:
+                styles_part = _related_part(archive, _main_part(archive), 'styles')
+                if styles_part in archive.namelist():
+                    styles = etree.fromstring(archive.read(styles_part))
+                    for style in styles.iterchildren(W_STYLE):
+                        if style.get(W_TYPE) != 'paragraph':
+                            continue
+                        name = style.find(W_NAME)
+                        name = BabelFish.internal2ui(name.get(W_VAL)) if name is not None else ''
+                        names[style.get(W_STYLE_ID)] = name
+                        if style.get(W_DEFAULT) in ('1', 'true', 'on'):
+                            names[None] = name
+            self._style_names = names
+        return self._style_names
+
+    def _iter_elements(self):
+        parser = etree.XMLPullParser(events=('end',), tag=W_PARAGRAPH, remove_blank_text=True, resolve_entities=False)
+        with zipfile.ZipFile(self.path) as archive, archive.open(_main_part(archive)) as f:
+            while True:
+                data = f.read(self.CHUNK_BYTES)
+                if data:
+                    parser.feed(data)
+                else:
+                    parser.close()
+                for _, p in parser.read_events():
+                    # Paragraphs inside tables are not body paragraphs
+                    body = p.getparent()
+                    if body is None or body.tag != W_BODY:
+                        continue
+                    yield p
+                    p.clear()
+                    while p.getprevious() is not None:
+                        del body[0]
+                if not data:
+                    break
+
+    def iter_paragraphs(self):
+        # (text, style id, [(run text, bold, italic, underline)]) per body paragraph,
+        # with the same text and formatting rules as python-docx
+        for p in self._iter_elements():
+            style = p.find(STYLE_PATH)
+            runs = [_stream_run(r) for r in _stream_runs(p)]
+            yield ''.join(run[0] for run in runs), style.get(W_VAL) if style is not None else None, runs
+
+    def iter_texts(self):
+        for p in self._iter_elements():
+            yield ''.join(_stream_run_text(r) for r in _stream_runs(p))
+
+# WordprocessingML tag and attribute names in Clark notation
+W_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+W_VAL = W_NS + 'val'
+W_BODY = W_NS + 'body'
+W_PARAGRAPH = W_NS + 'p'
+W_PARAGRAPH_PROPERTIES = W_NS + 'pPr'
+W_STYLE = W_NS + 'style'
+W_STYLE_ID = W_NS + 'styleId'
+W_NAME = W_NS + 'name'
+W_DEFAULT = W_NS + 'default'
+STYLE_PATH = f"{W_PARAGRAPH_PROPERTIES}/{W_NS}pStyle"
+RUN_CHARACTERS = {W_NS + 'tab': '\t', W_NS + 'ptab': '\t', W_NS + 'cr': '\n', W_NS + 'noBreakHyphen': '-'}
+
+def _stream_runs(p):
+    # Same runs as _paragraph_runs(): direct runs and runs inside hyperlinks
+    for child in p:
+        if child.tag == W_RUN:
+            yield child
+        elif child.tag == W_HYPERLINK:
+            yield from child.iterchildren(W_RUN)
+
+def _stream_run_text(r) -> str:
+    parts = []
+    for child in r:
+        tag = child.tag
+        if tag == W_TEXT:
+            parts.append(child.text or '')
+        elif tag == W_BREAK:
+            # Page and column breaks have no text equivalent
+            if child.get(W_TYPE, 'textWrapping') == 'textWrapping':
+                parts.append('\n')
+        elif tag in RUN_CHARACTERS:
+            parts.append(RUN_CHARACTERS[tag])
+    return ''.join(parts)
+
+def _stream_run(r) -> tuple:
+    bold = italic = underline = False
+    properties = r.find(W_RUN_PROPERTIES)
+    if properties is not None:
+        bold = _on_off(properties.find(W_BOLD))
+        italic = _on_off(properties.find(W_ITALIC))
+        element = properties.find(W_UNDERLINE)
+        value = element.get(W_VAL) if element is not None else None
+        underline = value is not None and value != 'none'
+    return _stream_run_text(r), bold, italic, underline
+
+def _on_off(element) -> bool:
+    if element is None:
+        return False
+    value = element.get(W_VAL)
+    return value is None or value in ('1', 'true', 'on')
+
+W_RUN = W_NS + 'r'
+W_HYPERLINK = W_NS + 'hyperlink'
+W_TEXT = W_NS + 't'
+W_BREAK = W_NS + 'br'
+W_TYPE = W_NS + 'type'
+W_RUN_PROPERTIES = W_NS + 'rPr'
+W_BOLD = W_NS + 'b'
+W_ITALIC = W_NS + 'i'
+W_UNDERLINE = W_NS + 'u'
+
+class EditorBackend:
+    name = "base"
+
+    def initialize(self):
+        pass
+
+    def open(self, path: str):
+        raise NotImplementedError
+
+    def close(self, save: bool = True):
+        raise NotImplementedError
+
+    def save(self):
+        raise NotImplementedError
+
+    def prepare_save(self):
+        # Captures what has to be written while the editor lock is held and returns a
+        # callable doing the slow part, which may run on another thread; None if there
+        # is nothing to write
+        return self.save
+
+    def apply_batch(self, changes: list) -> list:
+        # Applies the changes in order and returns, for each one, the list of changes
+        # that undoes it
+        raise NotImplementedError
+
+    def shutdown(self):
+        pass
+
+    def sibling(self) -> "EditorBackend":
+        # A backend for another document that shares this one's editor process
+        return type(self)()
+
+    def memory_estimate(self) -> int:
+        # Rough bytes held in this process for the open document
+        return 0
+
+    def take_dirty_paragraphs(self):
+        # Paragraph elements changed since the last call, or None if unknown
+        return set()
+
+    @property
+    def is_open(self) -> bool:
+        return False
+
+    @property
+    def document(self):
+        return None
+
+class WordComBackend(EditorBackend):
+    name = "com"
+
+    def __init__(self):
+        self.word_app = None
+        self.active_doc = None
+        self._owns_app = True
+        self._owner_thread = None
+        self._marshalled_doc = None
+        self._thread_doc = None
+
+    def initialize(self):
+        if self.word_app is not None:
+            return
+        try:
+            _load_win32()
+        except ImportError:
+            raise RuntimeError("Word automation requires pywin32")
+        self.word_app = win32com.client.Dispatch("Word.Application")
+        self.word_app.Visible = False
+
+    def sibling(self) -> "WordComBackend":
+        # Siblings open their documents in this backend's Word instance and leave
+        # quitting it to this backend
+        self.initialize()
+        backend = WordComBackend()
+        backend.word_app = self.word_app
+        backend._owns_app = False
+        return backend
+
+    def open(self, path: str):
+        if self.word_app is None:
+            self.initialize()
+        self.active_doc = self.word_app.Documents.Open(path)
+        self.active_doc.TrackRevisions = True
+        # COM objects belong to the thread that created them; the background saver
+        # gets its own proxy through a marshalled stream
+        self._owner_thread = threading.get_ident()
+        self._thread_doc = None
+        self._marshalled_doc = pythoncom.CoMarshalInterThreadInterfaceInStream(
+            pythoncom.IID_IDispatch, self.active_doc._oleobj_)
+
+    def close(self, save: bool = True):
+        if self.active_doc:
+            self._document_for_thread().Close(SaveChanges=save)
+            self.active_doc = None
+            self._marshalled_doc = None
+            self._thread_doc = None
+
+    def save(self):
+        self._document_for_thread().Save()
+
+    def _document_for_thread(self):
+        if threading.get_ident() == self._owner_thread:
+            return self.active_doc
+        if self._thread_doc is None and self._marshalled_doc is not None:
+            stream, self._marshalled_doc = self._marshalled_doc, None
+            self._thread_doc = win32com.client.Dispatch(
+                pythoncom.CoGetInterfaceAndReleaseStream(stream, pythoncom.IID_IDispatch))
+        return self._thread_doc or self.active_doc
+
+    def apply_batch(self, changes: list) -> list:
+        inverses = []
+        for change in changes:
+            change_type = change.get('type')
+            if change_type == 'insert':
+                position = change.get('position', 0)
+                text = change.get('text', '')
+                rng = self.active_doc.Range(position, position)
+                rng.InsertAfter(text)
+                formatting = change.get('formatting', {})
+                if formatting:
+                    self._apply_formatting(rng, formatting)
+                inverses.append([{'type': 'delete', 'start': rng.Start, 'end': rng.End}])
+            elif change_type == 'delete':
+                start = change.get('start', 0)
+                end = change.get('end', start)
+                rng = self.active_doc.Range(start, end)
+                removed = {'type': 'insert', 'position': rng.Start, 'text': rng.Text,
+                           'formatting': self._range_formatting(rng)}
+                rng.Delete()
+                inverses.append([removed])
+            elif change_type == 'replace':
+                start = change.get('start', 0)
+                end = change.get('end', start)
+                text = change.get('text', '')
+                rng = self.active_doc.Range(start, end)
+                removed = {'type': 'insert', 'position': rng.Start, 'text': rng.Text,
+                           'formatting': self._range_formatting(rng)}
+                rng.Text = text
+                formatting = change.get('formatting', {})
+                if formatting:
+                    self._apply_formatting(rng, formatting)
+                inverses.append([{'type': 'delete', 'start': rng.Start, 'end': rng.End}, removed])
+            elif change_type == 'format':
+                start = change.get('start', 0)
+                end = change.get('end', start)
+                formatting = change.get('formatting', {})
+                rng = self.active_doc.Range(start, end)
+                previous = self._range_formatting(rng, formatting)
+                self._apply_formatting(rng, formatting)
+                inverses.append([{'type': 'format', 'start': rng.Start, 'end': rng.End, 'formatting': previous}])
+            else:
+                logging.warning(f"Unknown change type: {change_type}")
+                inverses.append([])
+        return inverses
+
+    def _range_formatting(self, rng, keys=FORMAT_KEYS) -> dict:
+        font = rng.Font
+        values = {'bold': font.Bold, 'italic': font.Italic, 'underline': font.Underline,
+                  'size': font.Size, 'color': font.Color}
+        # Mixed formatting across the range reads back as wdUndefined
+        return {key: values[key] for key in keys if key in values and values[key] != WD_UNDEFINED}
+
+    def _apply_formatting(self, rng, formatting: dict):
+        try:
+            if formatting.get('bold') is not None:
+                rng.Font.Bold = formatting['bold']
+            if formatting.get('italic') is not None:
+                rng.Font.Italic = formatting['italic']
+            if formatting.get('underline') is not None:
+                rng.Font.Underline = formatting['underline']
+            if formatting.get('size') is not None:
+                rng.Font.Size = formatting['size']
+            if formatting.get('color') is not None:
+                rng.Font.Color = formatting['color']
+        except Exception as e:
+            logging.error(f"Error applying formatting: {e}")
+
+    def shutdown(self):
+        if self.word_app and self._owns_app:
+            self.word_app.Quit()
+        self.word_app = None
+
+    @property
+    def is_open(self) -> bool:
+        return self.active_doc is not None
+
+def _write_atomic(path: str, data: bytes):
+    # Readers and crashes see either the old file or the complete new one
+    temporary = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temporary, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            shutil.copymode(path, temporary)
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+def _write_docx_part(path: str, name: str, data: bytes):
+    # Rewrites the package at `path` with part `name` replaced by `data`
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(path) as source, zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as target:
+        for item in source.infolist():
+            target.writestr(item, data if item.filename == name else source.read(item))
+    _write_atomic(path, buffer.getvalue())
+
+def _to_rgb(color) -> "RGBColor":
+    if isinstance(color, str):
+        return RGBColor.from_string(color.lstrip('#'))
+    # Word stores colors as 0xBBGGRR integers
+    color = int(color)
+    return RGBColor(color & 0xFF, (color >> 8) & 0xFF, (color >> 16) & 0xFF)
+
+def _run_formatting(run: "Run") -> dict:
+    font = run.font
+    try:
+        color = f"#{font.color.rgb}" if font.color.rgb is not None else None
+    except Exception:
+        color = None
+    return {'bold': font.bold, 'italic': font.italic, 'underline': font.underline,
+            'size': font.size.pt if font.size is not None else None, 'color': color}
+
+def _restoring_formatting(formatting: dict, keys=FORMAT_KEYS) -> dict:
+    # Formatting that puts a run back to `formatting`; unset properties go in 'clear'
+    restored = {key: formatting[key] for key in keys if formatting.get(key) is not None}
+    cleared = [key for key in keys if formatting.get(key) is None]
+    if cleared:
+        restored['clear'] = cleared
+    return restored
+
+def _apply_run_formatting(run: "Run", formatting: dict):
+    # Like the COM backend, a bad value (e.g. color "red") is logged and skipped
+    # rather than aborting the batch halfway through
+    try:
+        for key in formatting.get('clear', ()):
+            if key == 'color':
+                run.font.color.rgb = None
+            else:
+                setattr(run.font, key, None)
+        if formatting.get('bold') is not None:
+            run.font.bold = formatting['bold']
+        if formatting.get('italic') is not None:
+            run.font.italic = formatting['italic']
+        if formatting.get('underline') is not None:
+            run.font.underline = formatting['underline']
+        if formatting.get('size') is not None:
+            run.font.size = Pt(formatting['size'])
+        if formatting.get('color') is not None:
+            run.font.color.rgb = _to_rgb(formatting['color'])
+    except Exception as e:
+        logging.error(f"Error applying formatting: {e}")
+
+def _paragraph_runs(paragraph) -> list:
+    # The runs that make up paragraph.text, including those inside hyperlinks
+    return paragraph._p.xpath('./w:r | ./w:hyperlink/w:r')
+
+class _ParagraphLayout:
+    # Character layout of the body paragraphs, kept in step with every edit so it is
+    # only built once per open document. Paragraphs are joined by a single separator,
+    # matching get_document_content(). Every paragraph element whose XML changes is
+    # added to `touched` so the analyzer can re-scan just those.
+    def __init__(self, document, touched: set):
+        _load_docx()
+        self.paragraphs = list(document.paragraphs)
+        self.index = OffsetIndex(len(self._text(p)) for p in self.paragraphs)
+        self.touched = touched
+
+    def _text(self, paragraph) -> str:
+        return ''.join(Run(r, paragraph).text for r in _paragraph_runs(paragraph))
+
+    def locate(self, offset: int):
+        if not self.paragraphs:
+            raise ValueError("Document has no paragraphs")
+        return self.index.locate(offset)
+
+    def _boundary(self, paragraph, local: int) -> int:
+        # Ensure a run boundary at `local` and return the index of the run that starts there
+        position = 0
+        runs = _paragraph_runs(paragraph)
+        for i, r in enumerate(runs):
+            run = Run(r, paragraph)
+            text = run.text
+            if position == local:
+                return i
+            if position < local < position + len(text):
+                tail = copy.deepcopy(r)
+                run.text = text[:local - position]
+                Run(tail, paragraph).text = text[local - position:]
+                r.addnext(tail)
+                self.touched.add(paragraph._p)
+                return i + 1
+            position += len(text)
+        return len(runs)
+
+    def _insert_runs(self, paragraph, local: int, text: str, formatting: dict):
+        index = self._boundary(paragraph, local)
+        runs = _paragraph_runs(paragraph)
+        if runs:
+            template = runs[index - 1] if index > 0 else runs[0]
+            new = copy.deepcopy(template)
+            if index > 0:
+                template.addnext(new)
+            else:
+                template.addprevious(new)
+            run = Run(new, paragraph)
+            run.text = text
+        else:
+            run = paragraph.add_run(text)
+        if formatting:
+            _apply_run_formatting(run, formatting)
+        self.touched.add(paragraph._p)
+
+    def _delete_local(self, paragraph, start: int, end: int):
+        if end <= start:
+            return
+        first = self._boundary(paragraph, start)
+        last = self._boundary(paragraph, end)
+        for r in _paragraph_runs(paragraph)[first:last]:
+            r.getparent().remove(r)
+        self.touched.add(paragraph._p)
+
+    def _split(self, index: int, local: int):
+        paragraph = self.paragraphs[index]
+        boundary = self._boundary(paragraph, local)
+        runs = _paragraph_runs(paragraph)
+        new_p = OxmlElement('w:p')
+        if paragraph._p.pPr is not None:
+            new_p.append(copy.deepcopy(paragraph._p.pPr))
+        if boundary < len(runs):
+            child = runs[boundary]
+            while child.getparent() is not paragraph._p:
+                child = child.getparent()
+            moving = [child] + list(child.itersiblings())
+            for element in moving:
+                new_p.append(element)
+        paragraph._p.addnext(new_p)
+        self.touched.update((paragraph._p, new_p))
+        self.paragraphs.insert(index + 1, Paragraph(new_p, paragraph._parent))
+        self.index.split(index, local)
+
+    def insert(self, offset: int, text: str, formatting: dict = None):
+        index, local = self.locate(offset)
+        for n, segment in enumerate(text.split('\n')):
+            if n:
+                self._split(index, local)
+                index, local = index + 1, 0
+            if segment:
+                self._insert_runs(self.paragraphs[index], local, segment, formatting)
+                self.index.resize(index, len(segment))
+                local += len(segment)
+
+    def delete(self, start: int, end: int):
+        if end <= start:
+            return
+        first, first_local = self.locate(start)
+        last, last_local = self.locate(end)
+        if first == last:
+            self._delete_local(self.paragraphs[first], first_local, last_local)
+            self.index.resize(first, first_local - last_local)
+            return
+        head = self.paragraphs[first]
+        tail = self.paragraphs[last]
+        self._delete_local(head, first_local, self.index.length(first))
+        self._delete_local(tail, 0, last_local)
+        for element in [c for c in tail._p if c.tag != W_PARAGRAPH_PROPERTIES]:
+            head._p.append(element)
+        self.touched.add(head._p)
+        for paragraph in self.paragraphs[first + 1:last + 1]:
+            paragraph._p.getparent().remove(paragraph._p)
+            self.touched.add(paragraph._p)
+        self.index.join(first, last, first_local + self.index.length(last) - last_local)
+        del self.paragraphs[first + 1:last + 1]
+
+    def capture(self, start: int, end: int) -> list:
+        # (text, run formatting) pieces covering [start, end), merging equal neighbours;
+        # paragraph breaks are included as '\n'
+        pieces = []
+
+        def add(text, formatting):
+            if pieces and pieces[-1][1] == formatting:
+                pieces[-1][0] += text
+            else:
+                pieces.append([text, formatting])
+
+        first, first_local = self.locate(start)
+        last, last_local = self.locate(end)
+        for index in range(first, last + 1):
+            if index > first:
+                add('\n', pieces[-1][1] if pieces else {})
+            paragraph = self.paragraphs[index]
+            lo = first_local if index == first else 0
+            hi = last_local if index == last else self.index.length(index)
+            position = 0
+            for r in _paragraph_runs(paragraph):
+                if position >= hi:
+                    break
+                run = Run(r, paragraph)
+                text = run.text
+                a, b = max(lo, position), min(hi, position + len(text))
+                if a < b:
+                    add(text[a - position:b - position], _run_formatting(run))
+                position += len(text)
+        return [tuple(piece) for piece in pieces]
+
+    def format(self, start: int, end: int, formatting: dict):
+        first, first_local = self.locate(start)
+        last, last_local = self.locate(end)
+        for index in range(first, last + 1):
+            paragraph = self.paragraphs[index]
+            lo = first_local if index == first else 0
+            hi = last_local if index == last else self.index.length(index)
+            if hi <= lo:
+                continue
+            begin = self._boundary(paragraph, lo)
+            stop = self._boundary(paragraph, hi)
+            for r in _paragraph_runs(paragraph)[begin:stop]:
+                _apply_run_formatting(Run(r, paragraph), formatting)
+            self.touched.add(paragraph._p)
+
+class DocxBackend(EditorBackend):
+    # The python-docx Document is only built on the first edit; until then reading
+    # and analysis go through DocxStreamReader and there is nothing to save
+    name = "docx"
+
+    # lxml trees take several times the size of the XML they were parsed from
+    TREE_BYTES_PER_XML_BYTE = 4
+
+    def __init__(self):
+        self._document = None
+        self._layout = None
+        self._dirty = set()
+        self._xml_bytes = 0
+        self.path = None
+
+    def open(self, path: str):
+        if not zipfile.is_zipfile(path):
+            raise ValueError(f"Not a .docx file: {path}")
+        with zipfile.ZipFile(path) as archive:
+            self._xml_bytes = archive.getinfo(_main_part(archive)).file_size
+        self._document = None
+        self._layout = None
+        self._dirty = set()
+        self.path = path
+
+    def close(self, save: bool = True):
+        if self.path is not None:
+            if save:
+                self.save()
+            self._document = None
+            self._layout = None
+            self.path = None
+
+    def save(self):
+        write = self.prepare_save()
+        if write is not None:
+            write()
+
+    def prepare_save(self):
+        # Edits only ever change the main document part, so only that part is
+        # serialized under the lock. Zipping it up with the package's other parts,
+        # copied from the file as they are, happens outside it.
+        if self._document is None:
+            return None
+        part = self._document.part
+        data = etree.tostring(part.element, encoding='UTF-8', standalone=True)
+        path, name = self.path, part.partname.lstrip('/')
+        return lambda: _write_docx_part(path, name, data)
+
+    def load(self):
+        if self._document is None:
+            _load_docx()
+            self._document = Document(self.path)
+        return self._document
+
+    def memory_estimate(self) -> int:
+        return self._xml_bytes * self.TREE_BYTES_PER_XML_BYTE if self._document is not None else 0
+
+    def apply_batch(self, changes: list):
+        self.load()
+        if self._layout is None:
+            # After a failed batch every paragraph counts as dirty until the caller
+            # takes that, so edits before then are not tracked separately
+            self._layout = _ParagraphLayout(self._document, self._dirty if self._dirty is not None else set())
+        inverses = []
+        try:
+            return self._apply(self._layout, changes, inverses)
+        except Exception:
+            # All or nothing: undo the changes that did apply, newest first
+            try:
+                self._apply(self._layout, [change for inverse in reversed(inverses) for change in inverse], [])
+            except Exception as e:
+                logging.error(f"Error rolling back a failed batch: {e}")
+            # A half-applied change may leave the layout out of step; rebuild it next
+            # time and report the whole document as dirty
+            self._layout = None
+            self._dirty = None
+            raise
+
+    def take_dirty_paragraphs(self):
+        dirty = self._dirty
+        self._dirty = set()
+        if self._layout is not None:
+            self._layout.touched = self._dirty
+        return dirty
+
+    def _apply(self, layout, changes: list, inverses: list) -> list:
+        # `inverses` is filled as changes apply, so a caller can roll back a failure
+        for change in changes:
+            change_type = change.get('type')
+            total = layout.index.total
+            if change_type == 'insert':
+                position = min(max(0, change.get('position', 0)), total)
+                text = change.get('text', '')
+                layout.insert(position, text, change.get('formatting'))
+                inverses.append([{'type': 'delete', 'start': position, 'end': position + len(text)}])
+            elif change_type in ('delete', 'replace'):
+                start = min(max(0, change.get('start', 0)), total)
+                end = min(max(start, change.get('end', start)), total)
+                inverse = self._reinsert(start, layout.capture(start, end))
+                layout.delete(start, end)
+                if change_type == 'replace':
+                    text = change.get('text', '')
+                    layout.insert(start, text, change.get('formatting'))
+                    inverse.insert(0, {'type': 'delete', 'start': start, 'end': start + len(text)})
+                inverses.append(inverse)
+            elif change_type == 'format':
+                start = min(max(0, change.get('start', 0)), total)
+                end = min(max(start, change.get('end', start)), total)
+                formatting = change.get('formatting', {})
+                keys = [key for key in FORMAT_KEYS if formatting.get(key) is not None]
+                inverse = []
+                position = start
+                for text, previous in layout.capture(start, end):
+                    inverse.append({'type': 'format', 'start': position, 'end': position + len(text),
+                                    'formatting': _restoring_formatting(previous, keys)})
+                    position += len(text)
+                layout.format(start, end, formatting)
+                inverses.append(inverse)
+            else:
+                logging.warning(f"Unknown change type: {change_type}")
+                inverses.append([])
+        return inverses
+
+    def _reinsert(self, start: int, pieces: list) -> list:
+        changes = []
+        position = start
+        for text, formatting in pieces:
+            changes.append({'type': 'insert', 'position': position, 'text': text,
+                            'formatting': _restoring_formatting(formatting)})
+            position += len(text)
+        return changes
+
+    @property
+    def is_open(self) -> bool:
+        return self.path is not None
+
+    @property
+    def document(self):
+        return self._document
+
+class MemoryBackend(EditorBackend):
+    # Plain-text stand-in for a real editor: paragraphs are kept as strings and
+    # formatting is accepted but not stored, so nothing is ever written back. Lets
+    # the editor, history and benchmarks run anywhere without Word or a .docx.
+    name = "memory"
+
+    def __init__(self, paragraphs: list = None):
+        self._text = None
+        self.path = None
+        if paragraphs is not None:
+            self.load_paragraphs(paragraphs)
+
+    def load_paragraphs(self, paragraphs: list):
+        self._text = ParagraphText(paragraphs)
+
+    def open(self, path: str):
+        self.load_paragraphs(DocxStreamReader(path).iter_texts())
+        self.path = path
+
+    def close(self, save: bool = True):
+        self._text = None
+        self.path = None
+
+    def save(self):
+        pass
+
+    def prepare_save(self):
+        return None
+
+    @property
+    def paragraphs(self) -> list:
+        return self._text.paragraphs if self._text is not None else None
+
+    @property
+    def text(self) -> str:
+        return self._text.text
+
+    def memory_estimate(self) -> int:
+        # Character data plus the per-object overhead of each paragraph string
+        if self._text is None:
+            return 0
+        return self._text.total + 56 * len(self._text.paragraphs)
+
+    def apply_batch(self, changes: list) -> list:
+        inverses = []
+        for change in changes:
+            change_type = change.get('type')
+            if change_type not in ('insert', 'delete', 'replace', 'format'):
+                logging.warning(f"Unknown change type: {change_type}")
+            inverses.append(self._text.apply_change(change))
+        return inverses
+
+    def take_dirty_paragraphs(self):
+        return None
+
+    @property
+    def is_open(self) -> bool:
+        return self._text is not None
+
+EDITOR_BACKENDS = {
+    WordComBackend.name: WordComBackend,
+    DocxBackend.name: DocxBackend,
+    MemoryBackend.name: MemoryBackend,
+}
+
+def create_editor_backend(name: str = None) -> EditorBackend:
+    if name is None:
+        name = os.environ.get("DOCUMENT_EDITOR_BACKEND") or ("com" if _win32_available() else "docx")
+    if name not in EDITOR_BACKENDS:
+        raise ValueError(f"Unknown editor backend: {name}")
+    return EDITOR_BACKENDS[name]()
+
+class _EditOp:
+    __slots__ = ('kind', 'start', 'end', 'text', 'formatting')
+
+    def __init__(self, kind, start, end, text='', formatting=None):
+        self.kind = kind
+        self.start = start
+        self.end = end
+        self.text = text
+        self.formatting = formatting or None
+
+    @classmethod
+    def from_change(cls, change: dict) -> "_EditOp":
+        kind = change.get('type')
+        if kind == 'insert':
+            position = change.get('position', 0)
+            return cls(kind, position, position, change.get('text', ''), change.get('formatting'))
+        start = change.get('start', 0)
+        return cls(kind, start, change.get('end', start), change.get('text', ''), change.get('formatting'))
+
+    def as_change(self) -> dict:
+        if self.kind == 'insert':
+            change = {'type': 'insert', 'position': self.start, 'text': self.text}
+        else:
+            change = {'type': self.kind, 'start': self.start, 'end': self.end}
+            if self.kind == 'replace':
+                change['text'] = self.text
+        if self.formatting:
+            change['formatting'] = self.formatting
+        return change
+
+class _HistoryEntry:
+    # One applied batch: the ops as applied and the ops that revert them, already
+    # in the order they have to be applied
+    __slots__ = ('forward', 'inverse', 'size', 'timestamp')
+
+    OP_OVERHEAD = 120
+
+    def __init__(self, forward: list, inverse: list):
+        self.forward = forward
+        self.inverse = inverse
+        self.timestamp = time.monotonic()
+        self.size = self._measure()
+
+    def _measure(self) -> int:
+        return sum(len(op.text) + self.OP_OVERHEAD for op in self.forward + self.inverse)
+
+class DocumentEditor:
+    # Consecutive single-op batches within this many seconds share one undo step
+    COALESCE_SECONDS = 2.0
+
+    def __init__(self, backend: EditorBackend = None, max_history_bytes: int = 16 * 1024 * 1024,
+                 autosaver: "WriteBehindSaver" = None, save_on_apply: bool = True):
+        self.backend = backend or create_editor_backend()
+        self.max_history_bytes = max_history_bytes
+        self.autosaver = autosaver
+        # Off for callers that save explicitly once they are done, like the batch runner
+        self.save_on_apply = save_on_apply
+        self.changes_stack = deque()
+        self.undo_stack = []
+        self.history_bytes = 0
+        self.doc_lock = threading.RLock()
+        # Every edit bumps the version; a save records the version it wrote. Saves are
+        # serialized by _save_lock, which is always taken before doc_lock.
+        self.unsaved_changes = 0
+        self._version = 0
+        self._saved_version = 0
+        self._save_lock = threading.Lock()
+
+    def initialize(self):
+        try:
+            self.backend.initialize()
+        except Exception as e:
+            logging.error(f"Failed to initialize {self.backend.name} backend: {e}")
+            raise
+
+    @property
+    def document(self):
+        return self.backend.document
+
+    @property
+    def has_document(self) -> bool:
+        return self.backend.is_open
+
+    def open_document(self, path: str) -> bool:
+        if self.backend.is_open:
+            self.close_document()
+        try:
+            self.backend.open(path)
+            self.clear_history()
+            self.unsaved_changes = 0
+            self._saved_version = self._version
+            return True
+        except Exception as e:
+            logging.error(f"Error opening document: {e}")
+            return False
+
+    def close_document(self, save: bool = True):
+        with self._save_lock, self.doc_lock:
+            if self.autosaver is not None:
+                self.autosaver.discard(self)
+            if self.backend.is_open:
+                self.backend.close(save=save and self.is_dirty)
+            self.unsaved_changes = 0
+            self._saved_version = self._version
+
+    def memory_estimate(self) -> int:
+        return self.backend.memory_estimate() + self.history_bytes
+
+    @property
+    def is_dirty(self) -> bool:
+        return self._version != self._saved_version
+
+    def save(self):
+        self.flush()
+
+    def flush(self):
+        # Writes the document if it changed since the last save. The document is only
+        # locked while the backend captures its state, not while the file is written.
+        with self._save_lock:
+            with self.doc_lock:
+                if not self.is_dirty or not self.backend.is_open:
+                    return
+                version, pending = self._version, self.unsaved_changes
+                write = self.backend.prepare_save()
+            if write is not None:
+                write()
+            with self.doc_lock:
+                self._saved_version = version
+                self.unsaved_changes -= pending
+
+    def _mark_dirty(self, count: int):
+        self._version += 1
+        self.unsaved_changes += count
+        if self.autosaver is not None:
+            self.autosaver.schedule(self)
+
+    def apply_changes(self, changes: list) -> bool:
+        try:
+            with self.doc_lock:
+                if not self.backend.is_open:
+                    logging.error("No active document to apply changes.")
+                    return False
+
+                logging.info(f"Applying {len(changes)} changes to the document.")
+                inverses = self.backend.apply_batch(changes)
+                self._record(changes, inverses)
+                self._mark_dirty(len(changes))
+        except Exception as e:
+            logging.error(f"Unexpected error applying changes: {e}")
+            return False
+        # Without a background saver every batch is written straight away. The edit
+        # stands even if that fails; the document stays dirty and is saved later.
+        if self.autosaver is None and self.save_on_apply:
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Error saving document: {e}")
+        return True
+
+    def take_dirty_paragraphs(self):
+        with self.doc_lock:
+            return self.backend.take_dirty_paragraphs()
+
+    def clear_history(self):
+        with self.doc_lock:
+            self.changes_stack.clear()
+            self.undo_stack.clear()
+            self.history_bytes = 0
+
+    def _record(self, changes: list, inverses: list):
+        forward = [_EditOp.from_change(change) for change in changes]
+        inverse = [_EditOp.from_change(change) for undo in reversed(inverses) for change in undo]
+        entry = _HistoryEntry(forward, inverse)
+        for undone in self.undo_stack:
+            self.history_bytes -= undone.size
+        self.undo_stack.clear()
+        if self.changes_stack and self._coalesce(self.changes_stack[-1], entry):
+            return
+        self.changes_stack.append(entry)
+        self.history_bytes += entry.size
+        # Drop the oldest steps once the history outgrows its memory budget
+        while self.history_bytes > self.max_history_bytes and len(self.changes_stack) > 1:
+            self.history_bytes -= self.changes_stack.popleft().size
+
+    def _coalesce(self, last: _HistoryEntry, entry: _HistoryEntry) -> bool:
+        if entry.timestamp - last.timestamp > self.COALESCE_SECONDS:
+            return False
+        if len(last.forward) != 1 or len(entry.forward) != 1 or len(last.inverse) != 1 or len(entry.inverse) != 1:
+            return False
+        previous, op = last.forward[0], entry.forward[0]
+        previous_undo, undo = last.inverse[0], entry.inverse[0]
+        if previous.kind != op.kind or previous.formatting != op.formatting:
+            return False
+        if op.kind == 'insert':
+            # Typing: the new text continues right where the previous insert ended
+            if op.start != previous.start + len(previous.text):
+                return False
+            previous.text += op.text
+            previous_undo.end += len(op.text)
+        elif op.kind == 'delete':
+            if previous_undo.formatting != undo.formatting:
+                return False
+            if op.end == previous.start:
+                # Backspace: the new deletion ends where the previous one started
+                previous.start = op.start
+                previous_undo.start = undo.start
+                previous_undo.text = undo.text + previous_undo.text
+            elif op.start == previous.start:
+                # Forward delete at the same position
+                previous.end += op.end - op.start
+                previous_undo.text += undo.text
+            else:
+                return False
+        else:
+            return False
+        self.history_bytes -= last.size
+        last.size = last._measure()
+        last.timestamp = entry.timestamp
+        self.history_bytes += last.size
+        return True
+
+    def undo(self):
+        # Returns the changes that were applied to revert the last step, or None
+        with self.doc_lock:
+            if not self.changes_stack or not self.backend.is_open:
+                return None
+            entry = self.changes_stack.pop()
+            changes = [op.as_change() for op in entry.inverse]
+            try:
+                self.backend.apply_batch(changes)
+            except Exception as e:
+                logging.error(f"Error undoing changes: {e}")
+                self.changes_stack.append(entry)
+                return None
+            self.undo_stack.append(entry)
+            self._mark_dirty(len(changes))
+            return changes
+
+    def redo(self):
+        with self.doc_lock:
+            if not self.undo_stack or not self.backend.is_open:
+                return None
+            entry = self.undo_stack.pop()
+            changes = [op.as_change() for op in entry.forward]
+            try:
+                self.backend.apply_batch(changes)
+            except Exception as e:
+                logging.error(f"Error redoing changes: {e}")
+                self.undo_stack.append(entry)
+                return None
+            self.changes_stack.append(entry)
+            self._mark_dirty(len(changes))
+            return changes
+
+    def shutdown(self):
+        try:
+            self.close_document()
+        finally:
+            self.backend.shutdown()
+
+class WriteBehindSaver:
+    # Saves edited documents on a background thread. Each edit pushes the document's
+    # save back by `delay` seconds so a burst of edits becomes one write, but a
+    # document is never left unsaved for more than `max_delay` seconds.
+    def __init__(self, delay: float = 1.0, max_delay: float = 10.0, metrics: Metrics = None):
+        self.delay = delay
+        self.max_delay = max_delay
+        self.metrics = metrics or default_metrics
+        self._due = {}
+        self._callbacks = {}
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopping = False
+
+    def start(self):
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="autosave", daemon=True)
+            self._thread.start()
+
+    def schedule(self, editor: DocumentEditor, delay: float = None, callback=None):
+        # callback(saved: bool) runs on the saver thread after the write
+        self.start()
+        now = time.monotonic()
+        with self._condition:
+            first = self._due.get(editor, (None, now))[1]
+            deadline = min(now + (self.delay if delay is None else delay), first + self.max_delay)
+            self._due[editor] = (deadline, first)
+            if callback is not None:
+                self._callbacks.setdefault(editor, []).append(callback)
+            self._condition.notify()
+
+    def save_now(self, editor: DocumentEditor, callback=None):
+        self.schedule(editor, 0, callback)
+
+    def discard(self, editor: DocumentEditor):
+        with self._condition:
+            self._due.pop(editor, None)
+            callbacks = self._callbacks.pop(editor, [])
+        for callback in callbacks:
+            self._callback(callback, False)
+
+    @property
+    def pending(self) -> int:
+        with self._condition:
+            return len(self._due)
+
+    def cache_info(self) -> dict:
+        with self._condition:
+            editors = list(self._due)
+        return {'pending_documents': len(editors),
+                'pending_changes': sum(editor.unsaved_changes for editor in editors)}
+
+    def flush(self):
+        # Saves everything still waiting, on the calling thread
+        with self._condition:
+            editors = list(self._due)
+        for editor in editors:
+            with self._condition:
+                if self._due.pop(editor, None) is None:
+                    continue
+            self._save(editor)
+
+    def shutdown(self, timeout: float = 30.0):
+        # Stops the thread once every pending document has been written
+        with self._condition:
+            thread = self._thread
+            self._stopping = True
+            self._condition.notify()
+        if thread is not None:
+            thread.join(timeout)
+        with self._condition:
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        if pythoncom:
+            pythoncom.CoInitialize()
+        try:
+            while True:
+                with self._condition:
+                    due = self._take_due()
+                    while not due and not self._stopping:
+                        now = time.monotonic()
+                        self._condition.wait(min(deadline for deadline, _ in self._due.values()) - now
+                                             if self._due else None)
+                        due = self._take_due()
+                    if not due and self._stopping:
+                        return
+                for editor in due:
+                    self._save(editor)
+        finally:
+            if pythoncom:
+                pythoncom.CoUninitialize()
+
+    def _take_due(self) -> list:
+        now = time.monotonic()
+        due = [editor for editor, (deadline, _) in self._due.items() if self._stopping or deadline <= now]
+        for editor in due:
+            del self._due[editor]
+        return due
+
+    def _save(self, editor: DocumentEditor):
+        with self._condition:
+            callbacks = self._callbacks.pop(editor, [])
+        started = time.perf_counter()
+        try:
+            editor.flush()
+            saved = True
+            self.metrics.observe('save_seconds', time.perf_counter() - started)
+        except Exception as e:
+            saved = False
+            self.metrics.count('save_errors')
+            logging.error(f"Error saving document: {e}")
+        for callback in callbacks:
+            self._callback(callback, saved)
+
+    def _callback(self, callback, saved: bool):
+        try:
+            callback(saved)
+        except Exception as e:
+            logging.error(f"Error in autosave callback: {e}")
+
+SENTENCE_END = re.compile(r'[.!?]+')
+
+class DocumentAnalyzer:
+    def __init__(self, max_cache_entries: int = 50000):
+        # Per-paragraph stats memoized by a hash of the paragraph XML, in LRU order
+        self.structure_cache = OrderedDict()
+        self.max_cache_entries = max_cache_entries
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_evictions = 0
+        self.statistics = {}
+        self._style_names = {}
+        self._document = None
+        self._paragraph_stats = {}
+        self._totals = [0] * 6
+        self._headings = {}
+
+    def analyze_document(self, doc: "Document", dirty_paragraphs=None) -> dict:
+        # With dirty_paragraphs (paragraph elements added, edited or removed since the
+        # last call on the same document) only those are re-scanned and the totals are
+        # updated by delta; otherwise every paragraph is visited once.
+        _load_docx()
+        if dirty_paragraphs is None or doc is not self._document:
+            self._reset(doc, {})
+            for paragraph in self._iter_paragraphs(doc):
+                self._add_paragraph(paragraph._p, self._cached_stats(paragraph))
+        else:
+            body = doc._body
+            for p in dirty_paragraphs:
+                previous = self._paragraph_stats.pop(p, None)
+                if previous is not None:
+                    self._remove_paragraph(previous)
+                if p.getparent() is not None:
+                    self._add_paragraph(p, self._cached_stats(Paragraph(p, body)))
+        self.statistics = self._build_statistics()
+        return self.statistics
+
+    def analyze_stream(self, paragraphs, style_names: dict, progress=None, progress_every: int = 5000) -> dict:
+        # Full analysis over DocxStreamReader.iter_paragraphs(). Nothing of the
+        # document is kept, so stats are keyed by position, and `progress` gets the
+        # statistics so far every `progress_every` paragraphs.
+        self._reset(None, {})
+        default_style = style_names.get(None, '')
+        for index, (text, style_id, runs) in enumerate(paragraphs):
+            bold = italic = underline = 0
+            for run_text, run_bold, run_italic, run_underline in runs:
+                if run_text:
+                    bold += run_bold
+                    italic += run_italic
+                    underline += run_underline
+            style_name = style_names.get(style_id, default_style)
+            self._add_paragraph(index, self._paragraph_stats_for(text, style_name, bold, italic, underline))
+            if progress is not None and index % progress_every == progress_every - 1:
+                progress(self._build_statistics())
+        self.statistics = self._build_statistics()
+        return self.statistics
+
+    def adopt(self, other: "DocumentAnalyzer"):
+        # Takes over the results of an analysis run on `other`, keeping this cache
+        self._reset(other._document, other._style_names)
+        self._paragraph_stats = other._paragraph_stats
+        self._totals = other._totals
+        self._headings = other._headings
+        self.statistics = other.statistics
+
+    def memory_estimate(self) -> int:
+        # Rough per-entry sizes of the structure cache and the per-paragraph stats
+        return 250 * len(self.structure_cache) + 200 * len(self._paragraph_stats)
+
+    def _reset(self, doc, style_names: dict):
+        self._document = doc
+        self._style_names = style_names
+        self._paragraph_stats = {}
+        self._totals = [0] * 6
+        self._headings = {}
+
+    def cache_info(self) -> dict:
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            'entries': len(self.structure_cache),
+            'max_entries': self.max_cache_entries,
+            'hits': self.cache_hits,
+            'misses': self.cache_misses,
+            'evictions': self.cache_evictions,
+            'hit_rate': self.cache_hits / lookups if lookups else 0.0
+        }
+
+    def _build_statistics(self) -> dict:
+        word_count, letter_count, sentence_count, bold_count, italic_count, underline_count = self._totals
+        return {
+            'word_count': word_count,
+            'paragraph_count': len(self._paragraph_stats),
+            'headings': {text: level for text, (level, _) in self._headings.items()},
+            'formatting': {
+                'bold_count': bold_count,
+                'italic_count': italic_count,
+                'underline_count': underline_count
+            },
+            'language_stats': {
+                'sentence_count': sentence_count,
+                'avg_word_length': letter_count / word_count if word_count else 0
+            }
+        }
+
+    def _add_paragraph(self, p, stats: tuple):
+        self._paragraph_stats[p] = stats
+        totals = self._totals
+        for i in range(6):
+            totals[i] += stats[i]
+        heading, level = stats[6], stats[7]
+        if level is not None:
+            count = self._headings[heading][1] if heading in self._headings else 0
+            self._headings[heading] = (level, count + 1)
+
+    def _remove_paragraph(self, stats: tuple):
+        totals = self._totals
+        for i in range(6):
+            totals[i] -= stats[i]
+        heading, level = stats[6], stats[7]
+        if level is not None and heading in self._headings:
+            previous_level, count = self._headings[heading]
+            if count > 1:
+                self._headings[heading] = (previous_level, count - 1)
+            else:
+                del self._headings[heading]
+
+    def _cached_stats(self, paragraph: "Paragraph") -> tuple:
+        key = hashlib.blake2b(etree.tostring(paragraph._p), digest_size=16).digest()
+        stats = self.structure_cache.get(key)
+        if stats is not None:
+            self.cache_hits += 1
+            self.structure_cache.move_to_end(key)
+            return stats
+        self.cache_misses += 1
+        stats = self._scan_paragraph(paragraph)
+        self.structure_cache[key] = stats
+        if len(self.structure_cache) > self.max_cache_entries:
+            self.structure_cache.popitem(last=False)
+            self.cache_evictions += 1
+        return stats
+
+    def _iter_paragraphs(self, doc: "Document"):
+        body = doc._body
+        for p in doc.element.body.iterchildren(W_PARAGRAPH):
+            yield Paragraph(p, body)
+
+    def _scan_paragraph(self, paragraph: "Paragraph") -> tuple:
+        # (words, letters, sentences, bold runs, italic runs, underlined runs, heading text, heading level)
+        bold = italic = underline = 0
+        parts = []
+        for r in _paragraph_runs(paragraph):
+            run = Run(r, paragraph)
+            text = run.text
+            if not text:
+                continue
+            parts.append(text)
+            bold += run.bold is True
+            italic += run.italic is True
+            underline += bool(run.underline)
+        return self._paragraph_stats_for(''.join(parts), self._style_name(paragraph), bold, italic, underline)
+
+    @staticmethod
+    def _paragraph_stats_for(text: str, style_name: str, bold: int, italic: int, underline: int) -> tuple:
+        words = text.split()
+        level = None
+        if style_name.startswith('Heading'):
+            level = style_name.split()[-1]
+        return (len(words), sum(map(len, words)), len(SENTENCE_END.findall(text)),
+                bold, italic, underline, text if level is not None else None, level)
+
+    def _style_name(self, paragraph: "Paragraph") -> str:
+        # Resolving a style walks the styles part, so do it once per style id
+        style_id = paragraph._p.style
+        if style_id not in self._style_names:
+            style = paragraph.style
+            self._style_names[style_id] = style.name if style is not None and style.name else ''
+        return self._style_names[style_id]
+
+class MistralAgentClient:
+    # Importing the Mistral SDK takes longer than building the whole window, so the
+    # SDK client is created on first use, or ahead of time by warm()
+    def __init__(self, mistral_client=None, agent_id: str = MISTRAL_AGENT_ID, api_key: str = None):
+        self._client = mistral_client
+        self.agent_id = agent_id
+        self.api_key = api_key
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    from mistralai import Mistral
+                    self._client = Mistral(api_key=self.api_key or os.environ.get('MISTRAL_API_KEY', MISTRAL_API_KEY))
+        return self._client
+
+    def warm(self):
+        return self.client
+
+    def complete(self, messages: list) -> str:
+        chat_response = self.client.agents.complete(agent_id=self.agent_id, messages=messages)
+        return chat_response.choices[0].message.content
+
+    async def stream(self, messages: list):
+        events = await self.client.agents.stream_async(agent_id=self.agent_id, messages=messages)
+        async for event in events:
+            delta = event.data.choices[0].delta.content if event.data.choices else None
+            if delta:
+                yield delta
+
+class ResponseCache:
+    # Two-tier cache of assistant responses: an in-memory LRU in front of an
+    # optional sqlite file. Entries expire after `ttl_seconds` and the disk tier
+    # evicts least recently used rows once it holds more than `max_disk_bytes`.
+    def __init__(self, path: str = None, max_memory_entries: int = 256,
+                 max_disk_bytes: int = 64 * 1024 * 1024, ttl_seconds: float = 7 * 24 * 3600):
+        self.path = path
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl_seconds = ttl_seconds
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.latency_saved = 0.0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._disk_bytes = 0
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                "latency REAL NOT NULL, size INTEGER NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+            self._db.execute("DELETE FROM responses WHERE created < ?", (time.time() - ttl_seconds,))
+            self._db.commit()
+            self._disk_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(document_text: str, message: str, history: list) -> str:
+        digest = hashlib.sha256()
+        for part in (document_text, message, json.dumps(history, sort_keys=True, default=str)):
+            encoded = part.encode('utf-8')
+            digest.update(len(encoded).to_bytes(8, 'little'))
+            digest.update(encoded)
+        return digest.hexdigest()
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                response, latency, created = entry
+                if now - created <= self.ttl_seconds:
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    self.latency_saved += latency
+                    return response
+                del self._memory[key]
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT response, latency, created FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and now - row[2] <= self.ttl_seconds:
+                    self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+                    self._db.commit()
+                    self._remember(key, row)
+                    self.disk_hits += 1
+                    self.latency_saved += row[1]
+                    return row[0]
+            self.misses += 1
+            return None
+
+    def put(self, key: str, response: str, latency: float):
+        now = time.time()
+        with self._lock:
+            self._remember(key, (response, latency, now))
+            if self._db is None:
+                return
+            size = len(response.encode('utf-8'))
+            previous = self._db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, response, latency, size, created, accessed) "
+                "VALUES (?, ?, ?, ?, ?, ?)", (key, response, latency, size, now, now)
+            )
+            self._disk_bytes += size - (previous[0] if previous else 0)
+            if self._disk_bytes > self.max_disk_bytes:
+                self._evict_disk()
+            self._db.commit()
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self):
+        evicted = []
+        for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY accessed"):
+            if self._disk_bytes <= self.max_disk_bytes:
+                break
+            evicted.append((key,))
+            self._disk_bytes -= size
+        self._db.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def cache_info(self) -> dict:
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                'memory_entries': len(self._memory),
+                'disk_bytes': self._disk_bytes,
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': hits / lookups if lookups else 0.0,
+                'latency_saved': self.latency_saved
+            }
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+class _PipelineRequest:
+    __slots__ = ('request_id', 'on_token', 'on_complete', 'cache_key', 'group', 'cached', 'task', 'buffer', 'chunks',
+                 'response')
+
+    def __init__(self, request_id, on_token, on_complete, cache_key=None, group=None):
+        self.request_id = request_id
+        self.on_token = on_token
+        self.on_complete = on_complete
+        self.cache_key = cache_key
+        self.group = group
+        self.cached = False
+        self.task = None
+        self.buffer = []
+        self.chunks = []
+        self.response = None
+
+class ResponsePipeline:
+    # Runs every LLM request on one long-lived asyncio loop thread. At most
+    # `max_in_flight` requests talk to the client at once, and tokens and results are
+    # handed to the callbacks strictly in submission order: a request that finishes
+    # early is buffered until everything submitted before it has been delivered.
+    # Callbacks run on the loop thread. Requests submitted with a cache_key, or a
+    # build_cache_key callable run in the executor, are answered from
+    # `response_cache` when possible and stored there on success.
+    def __init__(self, llm_client, max_in_flight: int = 2, response_cache: ResponseCache = None,
+                 metrics: Metrics = None):
+        self.llm_client = llm_client
+        self.max_in_flight = max_in_flight
+        self.response_cache = response_cache
+        self.metrics = metrics or default_metrics
+        self.loop = None
+        self._thread = None
+        self._semaphore = None
+        self._requests = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self.loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(ready,), name="llm-pipeline", daemon=True)
+        self._thread.start()
+        ready.wait()
+
+    def _run(self, ready):
+        asyncio.set_event_loop(self.loop)
+        self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        self.loop.call_soon(ready.set)
+        self.loop.run_forever()
+
+    def submit(self, build_messages, on_token, on_complete, supersede: bool = False, cache_key: str = None,
+               build_cache_key=None, group=None) -> int:
+        # build_messages and build_cache_key run in the default executor so neither the
+        # caller nor the loop waits on context preparation or hashing the document;
+        # on_complete receives the same dict as get_ai_response(). With supersede, the
+        # requests still in flight in the same group (all of them without a group) are
+        # cancelled.
+        self.start()
+        with self._lock:
+            request_id = self._next_id
+            self._next_id += 1
+        self.loop.call_soon_threadsafe(self._schedule, request_id, build_messages, on_token, on_complete, supersede,
+                                       cache_key, build_cache_key, group)
+        return request_id
+
+    def cancel(self, request_id: int):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._cancel, request_id)
+
+    def cancel_all(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._cancel_all)
+
+    def shutdown(self, timeout: float = 5.0):
+        if self._thread is None:
+            return
+        self.cancel_all()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _schedule(self, request_id, build_messages, on_token, on_complete, supersede, cache_key, build_cache_key,
+                  group):
+        if supersede:
+            self._cancel_all(group)
+        request = _PipelineRequest(request_id, on_token, on_complete, cache_key, group)
+        self._requests[request_id] = request
+        request.task = self.loop.create_task(self._execute(request, build_messages, build_cache_key))
+        request.task.add_done_callback(lambda task: self._finish(request, task))
+
+    def _cancel(self, request_id):
+        request = self._requests.get(request_id)
+        if request is not None and request.task is not None:
+            request.task.cancel()
+
+    def _cancel_all(self, group=None):
+        for request in self._requests.values():
+            if request.task is not None and (group is None or request.group == group):
+                request.task.cancel()
+
+    async def _execute(self, request, build_messages, build_cache_key=None):
+        if request.cache_key is None and build_cache_key is not None and self.response_cache is not None:
+            request.cache_key = await self.loop.run_in_executor(None, build_cache_key)
+        cache = self.response_cache if request.cache_key else None
+        if cache is not None:
+            cached = await self.loop.run_in_executor(None, cache.get, request.cache_key)
+            if cached is not None:
+                self.metrics.count('response_cache_hits')
+                request.cached = True
+                request.chunks.append(cached)
+                request.buffer.append(cached)
+                return
+            self.metrics.count('response_cache_misses')
+        messages = await self.loop.run_in_executor(None, build_messages)
+        async with self._semaphore:
+            started = time.perf_counter()
+            with self.metrics.span('llm', request_id=request.request_id):
+                async for token in self.llm_client.stream(messages):
+                    if not request.chunks:
+                        self.metrics.observe('llm_first_token_seconds', time.perf_counter() - started)
+                    request.chunks.append(token)
+                    request.buffer.append(token)
+                    self._deliver()
+        if cache is not None:
+            latency = time.perf_counter() - started
+            await self.loop.run_in_executor(None, cache.put, request.cache_key, ''.join(request.chunks), latency)
+
+    def _finish(self, request, task):
+        # A task cancelled before it first runs never enters _execute, so the
+        # outcome is read from the task itself
+        if task.cancelled():
+            request.response = {'message': ''.join(request.chunks), 'status': 'cancelled'}
+        elif task.exception() is not None:
+            request.response = {'message': f"Error getting AI response: {task.exception()}", 'status': 'error'}
+        else:
+            request.response = {'message': ''.join(request.chunks), 'status': 'success', 'cached': request.cached}
+        self._deliver()
+
+    def _deliver(self):
+        while self._requests:
+            request = next(iter(self._requests.values()))
+            if request.buffer:
+                text = ''.join(request.buffer)
+                request.buffer.clear()
+                self._callback(request.on_token, text)
+            if request.response is None:
+                return
+            del self._requests[request.request_id]
+            self._callback(request.on_complete, request.response)
+
+    def _callback(self, callback, value):
+        try:
+            callback(value)
+        except Exception as e:
+            logging.error(f"Error in pipeline callback: {e}")
+
+class ChatHistoryStore:
+    # Append-only log of chat turns, one JSON object per line, split into segment
+    # files named after the number of their first turn. Only the active (last)
+    # segment is scanned when a store is reopened; line offsets of older segments
+    # are indexed the first time they are read. The most recent turns are also kept
+    # in memory, and without a directory that is all the store keeps. Sealed
+    # segments beyond the newest `plain_segments` are compacted with gzip.
+    SEGMENT_PATTERN = re.compile(r'^(\d+)\.jsonl(\.gz)?$')
+
+    def __init__(self, directory: str = None, max_segment_bytes: int = 4 * 1024 * 1024,
+                 plain_segments: int = 4, recent_turns: int = 64):
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        self.plain_segments = plain_segments
+        self._recent = deque(maxlen=recent_turns)
+        self._starts = []
+        self._names = []
+        self._offsets = []
+        self._count = 0
+        self._file = None
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._open()
+
+    @classmethod
+    def for_document(cls, path: str, root: str = CHAT_HISTORY_DIR, **kwargs) -> "ChatHistoryStore":
+        name = hashlib.blake2b(os.path.abspath(path).encode('utf-8'), digest_size=8).hexdigest()
+        return cls(os.path.join(root, name), **kwargs)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _open(self):
+        segments = []
+        for name in os.listdir(self.directory):
+            match = self.SEGMENT_PATTERN.match(name)
+            if match:
+                segments.append((int(match.group(1)), name))
+        segments.sort()
+        if not segments:
+            segments.append((0, f"{0:012d}.jsonl"))
+        for start, name in segments:
+            self._starts.append(start)
+            self._names.append(name)
+            self._offsets.append(None)
+        self._index(len(self._names) - 1)
+        self._count = self._starts[-1] + len(self._offsets[-1]) - 1
+        self._file = open(self._path(len(self._names) - 1), 'ab')
+        self._recent.extend(self._read_range(max(0, self._count - self._recent.maxlen), self._count))
+
+    def _path(self, segment: int) -> str:
+        return os.path.join(self.directory, self._names[segment])
+
+    def _open_segment(self, segment: int):
+        path = self._path(segment)
+        return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+    def _index(self, segment: int):
+        # Offsets of every line start plus the end of the last complete line
+        offsets = array('q', [0])
+        position = 0
+        active = segment == len(self._names) - 1
+        if os.path.exists(self._path(segment)):
+            with self._open_segment(segment) as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    position += len(line)
+                    offsets.append(position)
+            if active and os.path.getsize(self._path(segment)) > position:
+                # Drop a line torn by a crash mid-write
+                with open(self._path(segment), 'r+b') as f:
+                    f.truncate(position)
+        self._offsets[segment] = offsets
+        return offsets
+
+    def _segment_of(self, turn: int) -> int:
+        return bisect.bisect_right(self._starts, turn) - 1
+
+    def _read_range(self, start: int, stop: int) -> list:
+        entries = []
+        turn = start
+        while turn < stop:
+            segment = self._segment_of(turn)
+            offsets = self._offsets[segment] or self._index(segment)
+            base = self._starts[segment]
+            last = min(stop - base, len(offsets) - 1)
+            if last <= turn - base:
+                break
+            with self._open_segment(segment) as f:
+                f.seek(offsets[turn - base])
+                for _ in range(turn - base, last):
+                    entries.append(json.loads(f.readline()))
+            turn = base + last
+        return entries
+
+    def append(self, role: str, content: str, timestamp: str = None) -> dict:
+        entry = {
+            'timestamp': timestamp or datetime.now().isoformat(timespec='seconds'),
+            'role': role,
+            'content': content
+        }
+        with self._lock:
+            if self._file is not None:
+                line = (json.dumps(entry, ensure_ascii=False) + '\n').encode('utf-8')
+                offsets = self._offsets[-1]
+                if offsets[-1] and offsets[-1] + len(line) > self.max_segment_bytes:
+                    self._rotate()
+                    offsets = self._offsets[-1]
+                self._file.write(line)
+                self._file.flush()
+                offsets.append(offsets[-1] + len(line))
+            self._recent.append(entry)
+            self._count += 1
+        return entry
+
+    def recent(self, count: int) -> list:
+        if count <= 0:
+            return []
+        with self._lock:
+            if count <= len(self._recent) or not self.directory:
+                return list(self._recent)[-count:]
+            return self._read_range(max(0, self._count - count), self._count)
+
+    def _rotate(self):
+        self._file.close()
+        self._starts.append(self._count)
+        self._names.append(f"{self._count:012d}.jsonl")
+        self._offsets.append(array('q', [0]))
+        self._file = open(self._path(len(self._names) - 1), 'ab')
+        self._compact()
+
+    def compact(self):
+        with self._lock:
+            if self._file is not None:
+                self._compact()
+
+    def _compact(self):
+        # Offsets stay valid because they index the uncompressed stream
+        sealed = len(self._names) - 1
+        for segment in range(max(0, sealed - self.plain_segments)):
+            name = self._names[segment]
+            if name.endswith('.gz'):
+                continue
+            source = self._path(segment)
+            target = f"{source}.gz"
+            with open(source, 'rb') as src, gzip.open(f"{target}.tmp", 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.replace(f"{target}.tmp", target)
+            os.remove(source)
+            self._names[segment] = f"{name}.gz"
+
+    def iter_turns(self):
+        # Streams every stored turn, oldest first, without loading the log
+        with self._lock:
+            if not self.directory:
+                entries = list(self._recent)
+            else:
+                entries = None
+                limits = [len(offsets) - 1 if offsets else None for offsets in self._offsets]
+                paths = [self._path(segment) for segment in range(len(self._names))]
+        if entries is not None:
+            yield from entries
+            return
+        for limit, path in zip(limits, paths):
+            if not os.path.exists(path):
+                # Compacted since the snapshot was taken
+                path = f"{path}.gz"
+            opener = gzip.open if path.endswith('.gz') else open
+            with opener(path, 'rb') as f:
+                for number, line in enumerate(f):
+                    if number == limit or not line.endswith(b'\n'):
+                        break
+                    yield json.loads(line)
+
+    def export(self, f, chunk_chars: int = 64 * 1024) -> int:
+        buffer = []
+        size = 0
+        count = 0
+        for entry in self.iter_turns():
+            text = f"[{entry['timestamp']}] {entry['role']}:\n{entry['content']}\n\n"
+            buffer.append(text)
+            size += len(text)
+            count += 1
+            if size >= chunk_chars:
+                f.write(''.join(buffer))
+                buffer.clear()
+                size = 0
+        f.write(''.join(buffer))
+        return count
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+class DocumentSession:
+    # Everything about one open document that does not need the GUI: the editor,
+    # analysis, the cached text with its indexes, context building and parsing of
+    # assistant modifications. Shared by DocumentChatApp and the batch runner.
+    # Chat history is persisted per document under `history_root` when given.
+    # Context building and parsing run off the Tk thread, so the cached text, its
+    # indexes and the analysis state are only touched under `_lock`, which edits,
+    # undo and redo take as well. Reading the whole document (the first text build,
+    # streamed analysis) happens outside it and is only installed if `_version`,
+    # bumped by every edit and reload, has not moved meanwhile.
+    HISTORY_TURNS = 5
+
+    def __init__(self, document_editor: DocumentEditor = None, document_analyzer: DocumentAnalyzer = None,
+                 context_token_budget: int = 6000, history_root: str = None, metrics: Metrics = None):
+        self.document_editor = document_editor or DocumentEditor()
+        self.document_analyzer = document_analyzer or DocumentAnalyzer()
+        self.context_token_budget = context_token_budget
+        self.history_root = history_root
+        self.metrics = metrics or default_metrics
+        self.document_path = None
+        self.reader = None
+        self.document_text = None
+        self.text_buffer = None
+        self.offset_index = None
+        self.chunk_index = None
+        self.chat_history = ChatHistoryStore()
+        self._document_digest = (None, None)
+        self._lock = threading.RLock()
+        self._version = 0
+
+    def load(self, path: str) -> bool:
+        with self._lock:
+            if not self.document_editor.open_document(path):
+                return False
+            self.document_path = path
+            self.reader = DocxStreamReader(path)
+            self.invalidate_text()
+            self.chat_history.close()
+            if self.history_root:
+                self.chat_history = ChatHistoryStore.for_document(path, self.history_root)
+            else:
+                self.chat_history = ChatHistoryStore()
+            return True
+
+    def record_turn(self, message: str, response: str):
+        self.chat_history.append("user", message)
+        self.chat_history.append("assistant", response)
+
+    def close(self, save: bool = True):
+        self.chat_history.close()
+        self.document_editor.close_document(save)
+
+    def memory_estimate(self) -> int:
+        # The cached paragraphs, their joined text and the chunk index, about three
+        # times the text
+        text = 3 * self.text_buffer.total if self.text_buffer is not None else 0
+        return text + self.document_editor.memory_estimate() + self.document_analyzer.memory_estimate()
+
+    def invalidate_text(self):
+        with self._lock:
+            self._version += 1
+            self.document_text = None
+            self.text_buffer = None
+            self.offset_index = None
+            self.chunk_index = None
+
+    @property
+    def is_loaded(self) -> bool:
+        return self.document_path is not None
+
+    @property
+    def current_document(self):
+        # The editor's python-docx Document, or None until an edit has built it
+        return self.document_editor.document
+
+    def analyze(self, progress=None) -> dict:
+        # Streams the file unless the editor already holds the document in memory
+        while True:
+            with self._lock:
+                document = self.current_document
+                if document is not None:
+                    with self.document_editor.doc_lock:
+                        return self.document_analyzer.analyze_document(document)
+                version, reader = self._version, self.reader
+            analyzer = DocumentAnalyzer()
+            statistics = analyzer.analyze_stream(reader.iter_paragraphs(), reader.style_names(), progress)
+            with self._lock:
+                if self._version == version:
+                    self.document_analyzer.adopt(analyzer)
+                    return statistics
+
+    def refresh_statistics(self):
+        # Re-analyze only the paragraphs the editor touched; None if nothing changed
+        with self._lock:
+            document = self.current_document
+            if document is None:
+                return None
+            with self.document_editor.doc_lock:
+                dirty = self.document_editor.take_dirty_paragraphs()
+                if dirty is not None and not dirty:
+                    return None
+                return self.document_analyzer.analyze_document(document, dirty)
+
+    def get_document_content(self) -> str:
+        while True:
+            with self._lock:
+                if not self.is_loaded:
+                    return ""
+                if self.text_buffer is not None:
+                    if self.document_text is None:
+                        # Edits only update the paragraphs; the joined text is built on demand
+                        self.document_text = self.text_buffer.text
+                    return self.document_text
+                version, reader, document = self._version, self.reader, self.current_document
+            if document is not None:
+                with self.document_editor.doc_lock:
+                    text_buffer = ParagraphText([p.text for p in document.paragraphs])
+            else:
+                text_buffer = ParagraphText(reader.iter_texts())
+            text = text_buffer.text
+            chunk_index = ChunkIndex(text)
+            with self._lock:
+                if self._version == version:
+                    self.text_buffer, self.offset_index = text_buffer, text_buffer.index
+                    self.document_text, self.chunk_index = text, chunk_index
+                    return text
+
+    def apply_modifications(self, modifications: list) -> bool:
+        with self._lock:
+            with self.metrics.span('apply_changes', changes=len(modifications)):
+                applied = self.document_editor.apply_changes(modifications)
+            if not applied:
+                # The editor may have touched the document before failing
+                self.invalidate_text()
+                return False
+            self._track_changes(modifications)
+            return True
+
+    def undo(self) -> bool:
+        with self._lock:
+            changes = self.document_editor.undo()
+            if changes is None:
+                return False
+            self._track_changes(changes)
+            return True
+
+    def redo(self) -> bool:
+        with self._lock:
+            changes = self.document_editor.redo()
+            if changes is None:
+                return False
+            self._track_changes(changes)
+            return True
+
+    def _track_changes(self, changes: list):
+        # Keep the cached paragraphs and their indexes in step with what the editor
+        # applied; each change costs about its own size, not the document's
+        self._version += 1
+        if self.text_buffer is None:
+            return
+        for change in changes:
+            self.text_buffer.apply_change(change)
+            self.chunk_index.apply_change(change, self.text_buffer.slice)
+        self.document_text = None
+
+    def response_cache_key(self, message) -> str:
+        # The first build of the text is slow, so it happens before taking the lock
+        self.get_document_content()
+        with self._lock:
+            content = self.get_document_content()
+            # Hashing the document is linear, so reuse the digest until the text changes
+            text, digest = self._document_digest
+            if text is not content:
+                digest = hashlib.sha256(content.encode('utf-8')).hexdigest()
+                self._document_digest = (content, digest)
+        # Only what reaches the prompt goes into the key; timestamps would make every turn miss
+        history = [{'role': turn['role'], 'content': turn['content']}
+                   for turn in self.chat_history.recent(self.HISTORY_TURNS)]
+        return ResponseCache.make_key(digest, message, history)
+
+    def build_messages(self, message, command) -> list:
+        with self.metrics.span('prepare_context') as span:
+            self.get_document_content()
+            with self._lock:
+                context = self.prepare_context(message, command)
+            content = self.format_context(context)
+            span.set(prompt_chars=len(content))
+        self.metrics.observe('prompt_chars', len(content))
+        self.metrics.observe('prompt_tokens', len(content) / CHARS_PER_TOKEN)
+        return [{"role": "user", "content": content}]
+
+    def prepare_context(self, message, command) -> dict:
+        return {
+            'message': message,
+            'command': command,
+            'document_content': self.select_document_context(message, command),
+            'chat_history': self.chat_history.recent(self.HISTORY_TURNS),
+            'document_stats': self.document_analyzer.statistics
+        }
+
+    def select_document_context(self, message, command) -> str:
+        content = self.get_document_content()
+        if len(content) <= self.context_token_budget * CHARS_PER_TOKEN:
+            return content
+        anchors = []
+        line_number, targets = self.parse_anchors(command)
+        if line_number:
+            anchors.append(self.offset_index.line_offset(line_number))
+        elif targets:
+            anchors.extend(start for start in resolve_anchors(content, targets) if start is not None)
+        spans = self.chunk_index.select(message, anchors, self.context_token_budget)
+        excerpts = [f"(Excerpts: {len(spans)} of {len(self.chunk_index)} sections, {len(content)} characters in total)"]
+        for start, end in spans:
+            line = self.offset_index.locate(start)[0] + 1
+            excerpts.append(f"[offset {start}, line {line}]\n{content[start:end]}")
+        return "\n\n".join(excerpts)
+
+    def format_context(self, context: dict) -> str:
+        return f"""
+        Current message: {context['message']}
+        
+        Document content:
+        {context['document_content']}
+        
+        Recent chat history:
+        {self._format_chat_history(context['chat_history'])}
+        
+        Document statistics:
+        {json.dumps(context['document_stats'], indent=2)}
+        """
+    
+    def _format_chat_history(self, history: list) -> str:
+        return "\n".join([f"{msg['role']}: {msg['content']}" for msg in history])
+    
+    def parse_modifications(self, response: str, command: str) -> list:
+        with self.metrics.span('parse_modifications', response_chars=len(response)) as span:
+            self.get_document_content()
+            with self._lock:
+                changes = self._parse_modifications(response, command)
+            span.set(changes=len(changes))
+        self.metrics.observe('change_batch_size', len(changes))
+        return changes
+
+    def _parse_modifications(self, response: str, command: str) -> list:
+        try:
+            blocks = extract_modification_blocks(response)
+            if not blocks:
+                logging.warning("No modification found in response.")
+                return []
+            changes = []
+            for block in blocks:
+                changes.extend(block.get('changes', []) if isinstance(block, dict) else block)
+            return rebase_changes(self._resolve_anchors(changes, command))
+        except Exception as e:
+            logging.error(f"Error parsing modifications: {e}")
+            return []
+
+    def _resolve_anchors(self, changes: list, command: str) -> list:
+        # Command anchors ("at line N", one or more find "text") place inserts that
+        # carry no anchor of their own, in order. A change may name its own target
+        # with "anchor" (text, or {"text", "occurrence"}) and "occurrence": inserts go
+        # right after the match, other changes cover it. Every target is resolved
+        # against the unedited text, one find_occurrence() scan per distinct target.
+        line_number, command_targets = self.parse_anchors(command)
+        own_targets = []
+        for change in changes:
+            anchor = change.pop('anchor', None)
+            occurrence = change.pop('occurrence', 1)
+            if isinstance(anchor, dict):
+                occurrence = anchor.get('occurrence', occurrence)
+                anchor = anchor.get('text')
+            own_targets.append((anchor, int(occurrence)) if anchor else None)
+        targets = command_targets + [target for target in own_targets if target]
+        if not targets and not line_number:
+            return changes
+        content = self.get_document_content()
+        starts = resolve_anchors(content, targets)
+        for (pattern, occurrence), start in zip(targets, starts):
+            if start is None:
+                logging.warning(f"Text '{pattern}' (occurrence {occurrence}) not found in the document.")
+        command_positions = []
+        if line_number:
+            command_positions.append(self.offset_index.line_offset(line_number))
+        else:
+            for (pattern, _), start in zip(command_targets, starts):
+                if start is not None:
+                    command_positions.append(start + len(pattern))
+        own_starts = iter(starts[len(command_targets):])
+        inserts = 0
+        for change, target in zip(changes, own_targets):
+            change_type = change.get('type')
+            if target is not None:
+                start = next(own_starts)
+                if start is None:
+                    continue
+                if change_type == 'insert':
+                    change['position'] = start + len(target[0])
+                else:
+                    change['start'] = start
+                    change['end'] = start + len(target[0])
+            elif change_type == 'insert' and command_positions:
+                change['position'] = command_positions[min(inserts, len(command_positions) - 1)]
+                inserts += 1
+        return changes
+    
+    def parse_anchors(self, command: str) -> tuple:
+        # (line number or None, [(find text, occurrence)]); "find the 2nd "x"" picks
+        # the second match and negative numbers count from the end
+        line_number = None
+        targets = []
+        if "at line" in command:
+            line_number_match = LINE_PATTERN.search(command)
+            if line_number_match:
+                line_number = int(line_number_match.group(1))
+        elif "find" in command:
+            for match in FIND_PATTERN.finditer(command):
+                if match.group(2):
+                    targets.append((match.group(2), int(match.group(1) or 1)))
+        return line_number, targets
+
+class SessionPool:
+    # Open documents keyed by absolute path, each a DocumentSession with its own
+    # analyzer cache, indexes and history. Every session's backend is a sibling of one
+    # shared backend, so the COM backend drives a single Word process for all of them.
+    # The least recently used documents are saved and closed once the pool holds more
+    # than `max_sessions` documents or its estimated memory exceeds `max_memory_bytes`;
+    # the active document is never evicted. With an autosaver, unsaved documents are
+    # written on its thread and only closed once that is done; until then reopening
+    # one takes it straight back.
+    def __init__(self, backend: EditorBackend = None, max_sessions: int = 8,
+                 max_memory_bytes: int = 512 * 1024 * 1024, context_token_budget: int = 6000,
+                 history_root: str = None, metrics: Metrics = None, autosaver: WriteBehindSaver = None):
+        self.backend = backend or create_editor_backend()
+        self.autosaver = autosaver
+        self.max_sessions = max_sessions
+        self.max_memory_bytes = max_memory_bytes
+        self.context_token_budget = context_token_budget
+        self.history_root = history_root
+        self.metrics = metrics or default_metrics
+        self.sessions = OrderedDict()
+        self.active = None
+        self._closing = {}
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    def __contains__(self, path: str) -> bool:
+        return os.path.abspath(path) in self.sessions
+
+    @property
+    def paths(self) -> list:
+        # Open documents, least recently used first
+        return list(self.sessions)
+
+    def open(self, path: str) -> DocumentSession:
+        # Returns the already open session for `path` or loads a new one; None on failure
+        key = os.path.abspath(path)
+        with self._lock:
+            session = self.sessions.get(key)
+            if session is None and key in self._closing:
+                session = self.sessions[key] = self._closing.pop(key)
+            if session is not None:
+                self.sessions.move_to_end(key)
+                self.active = session
+                self.metrics.count('session_pool_hits')
+                self._evict()
+                return session
+            try:
+                self.backend.initialize()
+            except Exception as e:
+                logging.error(f"Failed to initialize {self.backend.name} backend: {e}")
+                return None
+            session = DocumentSession(DocumentEditor(self.backend.sibling(), autosaver=self.autosaver), DocumentAnalyzer(),
+                                      self.context_token_budget, self.history_root, self.metrics)
+            if not session.load(key):
+                return None
+            self.metrics.count('session_pool_misses')
+            self.sessions[key] = session
+            self.active = session
+            self._evict()
+            return session
+
+    def close(self, path: str, save: bool = True):
+        key = os.path.abspath(path)
+        with self._lock:
+            session = self.sessions.pop(key, None)
+            if session is None:
+                return
+            if session is self.active:
+                self.active = None
+            self._close_session(key, session, save)
+
+    def _close_session(self, key: str, session: DocumentSession, save: bool):
+        if save and self.autosaver is not None and session.document_editor.is_dirty:
+            # Keep the caller's thread off the disk: save on the autosave thread, then close
+            self._closing[key] = session
+            self.autosaver.save_now(session.document_editor, lambda saved: self._reap())
+            return
+        try:
+            session.close(save)
+        except Exception as e:
+            logging.error(f"Error closing document {key}: {e}")
+
+    def _reap(self):
+        # Closes the documents whose background save has finished
+        with self._lock:
+            for key, session in list(self._closing.items()):
+                if self._closing.get(key) is not session:
+                    continue
+                if session.document_editor.is_dirty:
+                    # The save failed or a late reply edited it again; retry after the usual delay
+                    self.autosaver.schedule(session.document_editor, callback=lambda saved: self._reap())
+                    continue
+                del self._closing[key]
+                self._close_session(key, session, True)
+
+    @property
+    def closing(self) -> int:
+        # Evicted or closed documents still waiting for their background save
+        with self._lock:
+            return len(self._closing)
+
+    def memory_usage(self) -> int:
+        with self._lock:
+            return sum(session.memory_estimate() for session in self.sessions.values())
+
+    def _evict(self):
+        usage = self.memory_usage()
+        for key in list(self.sessions):
+            if len(self.sessions) <= self.max_sessions and usage <= self.max_memory_bytes:
+                break
+            session = self.sessions[key]
+            if session is self.active:
+                continue
+            usage -= session.memory_estimate()
+            del self.sessions[key]
+            self._close_session(key, session, True)
+            self.metrics.count('session_pool_evictions')
+
+    def shutdown(self):
+        # Saves and closes everything on the calling thread
+        with self._lock:
+            self.autosaver = None
+            self._closing, closing = {}, self._closing
+            self.sessions.update(closing)
+            while self.sessions:
+                key, session = self.sessions.popitem()
+                self._close_session(key, session, True)
+            self.active = None
+            try:
+                self.backend.shutdown()
+            except Exception as e:
+                logging.error(f"Error shutting down {self.backend.name} backend: {e}")
+
+class ChatTranscript:
+    # Every chat message shown in the display, kept as parallel lists so a long
+    # session costs a few small objects per message
+    def __init__(self):
+        self.roles = []
+        self.timestamps = []
+        self.texts = []
+        self.closed = []
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def add(self, role: str, timestamp: str, text: str, closed: bool) -> int:
+        self.roles.append(sys.intern(role))
+        self.timestamps.append(timestamp)
+        self.texts.append(text)
+        self.closed.append(closed)
+        return len(self.texts) - 1
+
+    def extend(self, message_id: int, text: str):
+        self.texts[message_id] += text
+
+    def close(self, message_id: int):
+        self.closed[message_id] = True
+
+    def header(self, message_id: int) -> str:
+        return f"\n[{self.timestamps[message_id]}] {self.roles[message_id]}:\n"
+
+    def render(self, message_id: int) -> str:
+        trailer = "\n" if self.closed[message_id] else ""
+        return f"{self.header(message_id)}{self.texts[message_id]}{trailer}"
+
+class ChatView:
+    # Renders a ChatTranscript into a text widget. Appends from any thread are queued
+    # and drained once per frame in a single widget update; only the most recent
+    # `max_messages` stay in the widget and older ones are paged back in when the
+    # view is scrolled to the top. Each rendered message starts at a mark named
+    # msg<id>, with right gravity so text inserted at a message boundary lands in
+    # the earlier message.
+    def __init__(self, root, widget, max_messages: int = 200, page_size: int = 50, frame_ms: int = CHAT_FRAME_MS):
+        self.root = root
+        self.widget = widget
+        self.max_messages = max_messages
+        self.page_size = page_size
+        self.frame_ms = frame_ms
+        self.transcript = ChatTranscript()
+        self._pending = []
+        self._lock = threading.Lock()
+        self._scheduled = False
+        self._first = 0
+        self._rendered = 0
+        for sequence in ('<MouseWheel>', '<Button-4>', '<Prior>', '<Control-Home>'):
+            widget.bind(sequence, lambda e: self.root.after_idle(self._page_in), add='+')
+
+    def post(self, role: str, text: str) -> int:
+        return self._queue(role, text, True)
+
+    def begin_message(self, role: str) -> int:
+        return self._queue(role, '', False)
+
+    def extend_message(self, message_id: int, text: str):
+        with self._lock:
+            self.transcript.extend(message_id, text)
+            self._pending.append((message_id, text))
+        self._schedule()
+
+    def finish_message(self, message_id: int):
+        # The closing newline is only queued for the widget; the transcript adds it
+        # when rendering a closed message
+        with self._lock:
+            self.transcript.close(message_id)
+            self._pending.append((message_id, "\n"))
+        self._schedule()
+
+    def _queue(self, role: str, text: str, closed: bool) -> int:
+        timestamp = datetime.now().strftime("%H:%M")
+        with self._lock:
+            message_id = self.transcript.add(role, timestamp, text, closed)
+            self._pending.append((message_id, None))
+        self._schedule()
+        return message_id
+
+    def _schedule(self):
+        with self._lock:
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self.root.after(self.frame_ms, self.flush)
+
+    def flush(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = []
+            self._scheduled = False
+            # New messages are rendered from the transcript, which already holds
+            # any text queued for them since
+            new_messages = {message_id for message_id, text in pending if text is None}
+            chunks = []
+            for message_id, text in pending:
+                if text is None:
+                    chunks.append((message_id, self.transcript.render(message_id), True))
+                elif message_id not in new_messages:
+                    chunks.append((message_id, text, False))
+        if not chunks:
+            return
+        at_bottom = self.widget.yview()[1] >= 0.999
+        self.widget.configure(state=tk.NORMAL)
+        for message_id, text, is_new in chunks:
+            if is_new:
+                start = self.widget.index("end-1c")
+                self.widget.insert("end-1c", text)
+                self.widget.mark_set(f"msg{message_id}", start)
+                self.widget.mark_gravity(f"msg{message_id}", tk.RIGHT)
+                self._rendered = message_id + 1
+            elif message_id >= self._first:
+                self.widget.insert(self._message_end(message_id), text)
+        if at_bottom:
+            self._trim()
+        self.widget.configure(state=tk.DISABLED)
+        if at_bottom:
+            self.widget.see(tk.END)
+
+    def _message_end(self, message_id: int) -> str:
+        if message_id + 1 < self._rendered:
+            return f"msg{message_id + 1}"
+        return "end-1c"
+
+    def _trim(self):
+        excess = (self._rendered - self._first) - self.max_messages
+        if excess <= 0:
+            return
+        keep = self._first + excess
+        self.widget.delete("1.0", f"msg{keep}")
+        for message_id in range(self._first, keep):
+            self.widget.mark_unset(f"msg{message_id}")
+        self._first = keep
+
+    def _page_in(self):
+        if self._first == 0 or self.widget.yview()[0] > 0:
+            return
+        with self._lock:
+            start = max(0, self._first - self.page_size)
+            texts = [self.transcript.render(message_id) for message_id in range(start, self._first)]
+        anchor = f"msg{self._first}"
+        self.widget.configure(state=tk.NORMAL)
+        self.widget.insert("1.0", ''.join(texts))
+        offset = 0
+        for message_id, text in zip(range(start, self._first), texts):
+            self.widget.mark_set(f"msg{message_id}", f"1.0 + {offset} chars")
+            self.widget.mark_gravity(f"msg{message_id}", tk.RIGHT)
+            offset += len(text)
+        self.widget.configure(state=tk.DISABLED)
+        self.widget.see(anchor)
+        self._first = start
+
+class DocumentChatApp:
+    def __init__(self, context_token_budget: int = 6000, llm_client=None, max_in_flight: int = 2,
+                 response_cache: ResponseCache = None, backend: str = None, api_key: str = None,
+                 agent_id: str = MISTRAL_AGENT_ID, supersede_requests: bool = True):
+        # With supersede_requests a new message cancels the replies still streaming
+        # for the same document, whose edits would target text it is about to change
+        self.supersede_requests = supersede_requests
+        self.root = ctk.CTk()
+        self.root.title("Advanced Document Chat Assistant")
+        self.root.geometry("1400x900")
+        ctk.set_appearance_mode("dark")
+        ctk.set_default_color_theme("blue")
+        self.event_system = DocumentEventSystem()
+        self.metrics = default_metrics
+        self.metrics.event_system = self.event_system
+        self.autosaver = WriteBehindSaver(metrics=self.metrics)
+        self.session_pool = SessionPool(create_editor_backend(backend), context_token_budget=context_token_budget,
+                                        history_root=CHAT_HISTORY_DIR, metrics=self.metrics, autosaver=self.autosaver)
+        # Stands in until the first document is opened
+        self.session = DocumentSession(context_token_budget=context_token_budget, metrics=self.metrics)
+        self.llm_client = llm_client or MistralAgentClient(agent_id=agent_id, api_key=api_key)
+        self.response_cache = response_cache or ResponseCache(RESPONSE_CACHE_PATH)
+        self.response_pipeline = ResponsePipeline(self.llm_client, max_in_flight, self.response_cache, self.metrics)
+        self.metrics.add_collector('response_cache', self.response_cache.cache_info)
+        self.metrics.add_collector('structure_cache', lambda: self.document_analyzer.cache_info())
+        self.metrics.add_collector('autosave', self.autosaver.cache_info)
+        self.metrics.add_collector('session_pool', lambda: {'documents': len(self.session_pool),
+                                                             'closing': self.session_pool.closing,
+                                                             'memory_bytes': self.session_pool.memory_usage()})
+        self.setup_ui()
+        self.setup_keyboard_shortcuts()
+        self.root.after_idle(self._on_first_frame)
+
+    def _on_first_frame(self):
+        # Idle callbacks run after Tk has drawn the window, so this is the first frame
+        elapsed = time.perf_counter() - STARTED
+        self.metrics.observe('first_window_seconds', elapsed)
+        logging.info(f"First window after {elapsed:.3f}s")
+        if os.environ.get('DOCUMENT_ASSISTANT_STARTUP_PROBE'):
+            print(f"first_window_seconds {elapsed:.6f}", flush=True)
+            self.root.after(0, self.root.quit)
+            return
+        threading.Thread(target=self._warm_up, name="warm-up", daemon=True).start()
+
+    def _warm_up(self):
+        # Loads the LLM client in the background so the first message does not pay for it
+        started = time.perf_counter()
+        try:
+            warm = getattr(self.llm_client, 'warm', None)
+            if warm is not None:
+                warm()
+            self.metrics.observe('warm_up_seconds', time.perf_counter() - started)
+        except Exception as e:
+            logging.error(f"Error warming up the LLM client: {e}")
+
+    @property
+    def document_editor(self) -> DocumentEditor:
+        return self.session.document_editor
+
+    @property
+    def document_analyzer(self) -> DocumentAnalyzer:
+        return self.session.document_analyzer
+    
+    def setup_ui(self):
+        self.main_container = ctk.CTkFrame(self.root)
+        self.main_container.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        self.setup_sidebar()
+        self.setup_main_content()
+    
+    def setup_sidebar(self):
+        sidebar = ctk.CTkFrame(self.main_container, width=200)
+        sidebar.pack(side=tk.LEFT, fill=tk.Y, padx=(0, 10))
+        self.browse_button = ctk.CTkButton(sidebar, text="Open Document", command=self.browse_file)
+        self.browse_button.pack(pady=5, padx=5, fill=tk.X)
+        self.document_menu = ctk.CTkOptionMenu(sidebar, values=["No documents"], command=self._select_document,
+                                               dynamic_resizing=False)
+        self.document_menu.pack(pady=5, padx=5, fill=tk.X)
+        self._document_labels = {}
+        operations_frame = ctk.CTkFrame(sidebar)
+        operations_frame.pack(fill=tk.X, pady=5, padx=5)
+        ctk.CTkButton(operations_frame, text="Analyze Document", command=self.analyze_document).pack(fill=tk.X, pady=2)
+        ctk.CTkButton(operations_frame, text="Export Chat", command=self.export_chat).pack(fill=tk.X, pady=2)
+        self.stats_display = ctk.CTkTextbox(sidebar, height=200, wrap=tk.WORD)
+        self.stats_display.pack(fill=tk.X, pady=5, padx=5)
+        actions_frame = ctk.CTkFrame(sidebar)
+        actions_frame.pack(fill=tk.X, pady=5, padx=5)
+        ctk.CTkButton(actions_frame, text="↩ Undo", command=self.undo_change).pack(side=tk.LEFT, expand=True, padx=2)
+        ctk.CTkButton(actions_frame, text="↪ Redo", command=self.redo_change).pack(side=tk.LEFT, expand=True, padx=2)
+    
+    def setup_main_content(self):
+        self.chat_frame = ctk.CTkFrame(self.main_container)
+        self.chat_frame.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.chat_display = ctk.CTkTextbox(self.chat_frame, wrap=tk.WORD, font=("Arial", 12))
+        self.chat_display.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        self.chat_view = ChatView(self.root, self.chat_display)
+        input_frame = ctk.CTkFrame(self.chat_frame)
+        input_frame.pack(fill=tk.X, pady=5, padx=5)
+        self.input_field = ctk.CTkTextbox(input_frame, height=100, font=("Arial", 12))
+        self.input_field.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 5))
+        send_button = ctk.CTkButton(input_frame, text="Send", command=self.send_message)
+        send_button.pack(side=tk.RIGHT)
+    
+    def setup_keyboard_shortcuts(self):
+        self.root.bind('<Control-z>', lambda e: self.undo_change())
+        self.root.bind('<Control-y>', lambda e: self.redo_change())
+        self.root.bind('<Control-s>', lambda e: self.save_document())
+        self.root.bind('<Escape>', lambda e: self.response_pipeline.cancel_all())
+        self.input_field.bind('<Control-Return>', lambda e: self.send_message())
+    
+    def browse_file(self):
+        file_path = filedialog.askopenfilename(filetypes=[("Word Documents", "*.docx"), ("All Files", "*.*")])
+        if file_path:
+            self.load_document(file_path)
+    
+    def load_document(self, path):
+        try:
+            reopened = path in self.session_pool
+            session = self.session_pool.open(path)
+            if session is None:
+                self.append_to_chat("System", "Error initializing real-time editing.")
+                return
+            self.session = session
+            self._refresh_document_menu()
+            if reopened:
+                self.append_to_chat("System", f"Switched to {os.path.basename(path)}.")
+                if self.document_analyzer.statistics:
+                    self.update_stats_display(self.document_analyzer.statistics)
+                    return
+            else:
+                self.append_to_chat("System", "Document loaded successfully!")
+            self.analyze_document()
+        except Exception as e:
+            self.append_to_chat("System", f"Error loading document: {str(e)}")
+
+    def switch_document(self, path):
+        self.load_document(path)
+
+    def _select_document(self, label):
+        path = self._document_labels.get(label)
+        if path is not None and self.session.document_path != path:
+            self.switch_document(path)
+
+    def _refresh_document_menu(self):
+        # Most recently used first; duplicate file names are told apart by their folder
+        self._document_labels = {}
+        for path in reversed(self.session_pool.paths):
+            label = os.path.basename(path)
+            if label in self._document_labels:
+                label = f"{label} ({os.path.basename(os.path.dirname(path))})"
+            self._document_labels[label] = path
+        labels = list(self._document_labels) or ["No documents"]
+        self.document_menu.configure(values=labels)
+        self.document_menu.set(labels[0])
+    
+    def analyze_document(self):
+        if not self.session.is_loaded:
+            self.append_to_chat("System", "Please load a document first!")
+            return
+        # Large documents are streamed on a worker thread, showing partial stats as it goes.
+        # Stats are dropped if the user switched to another document in the meantime.
+        session = self.session
+
+        def show(stats):
+            self.root.after(0, lambda: session is self.session and self.update_stats_display(stats))
+
+        def analyze():
+            try:
+                show(session.analyze(show))
+            except Exception as e:
+                self.append_to_chat("System", f"Error analyzing document: {e}")
+
+        threading.Thread(target=analyze, name="document-analysis", daemon=True).start()
+    
+    def update_stats_display(self, stats):
+        self.stats_display.configure(state=tk.NORMAL)
+        self.stats_display.delete('1.0', tk.END)
+        self.stats_display.insert(tk.END, "Document Statistics:\n\n")
+        self.stats_display.insert(tk.END, f"Words: {stats['word_count']}\n")
+        self.stats_display.insert(tk.END, f"Paragraphs: {stats['paragraph_count']}\n")
+        self.stats_display.insert(tk.END, f"Sentences: {stats['language_stats']['sentence_count']}\n")
+        self.stats_display.insert(tk.END, f"Avg. Word Length: {stats['language_stats']['avg_word_length']:.2f}\n")
+        self.stats_display.configure(state=tk.DISABLED)
+    
+    def send_message(self):
+        message = self.input_field.get("1.0", tk.END).strip()
+        command = message  # Assuming the entire message is the command
+        if not message:
+            return
+        if not self.session.is_loaded:
+            self.append_to_chat("System", "Please load a document first!")
+            return
+        self.input_field.delete("1.0", tk.END)
+        self.append_to_chat("You", message)
+        # The reply is parsed and applied against the document it was asked about, even
+        # if the user switches documents while it streams
+        session = self.session
+        on_token, on_complete = self._stream_callbacks(message, command, session)
+        self.response_pipeline.submit(lambda: session.build_messages(message, command), on_token, on_complete,
+                                      supersede=self.supersede_requests,
+                                      build_cache_key=lambda: session.response_cache_key(message),
+                                      group=session.document_path)
+    
+    def _stream_callbacks(self, message, command, session=None):
+        session = session or self.session
+        message_id = None
+        started = time.perf_counter()
+
+        def on_token(text):
+            nonlocal message_id
+            if message_id is None:
+                message_id = self.chat_view.begin_message("Assistant")
+            self.chat_view.extend_message(message_id, text)
+
+        def on_complete(response):
+            self.metrics.observe('request_seconds', time.perf_counter() - started)
+            self.metrics.count(f"requests_{response['status']}")
+            if message_id is not None:
+                self.chat_view.finish_message(message_id)
+            if response['status'] == 'success':
+                session.record_turn(message, response['message'])
+            # Parsing and applying happen on the Tk thread, in the order replies arrive
+            self.root.after(0, lambda: self._update_chat_callback(response, command, session))
+
+        return on_token, on_complete
+    
+    def _update_chat_callback(self, response, command, session=None):
+        logging.info(f"AI Response: {response}")
+        session = session or self.session
+        if response['status'] == 'success':
+            modifications = session.parse_modifications(response['message'], command)
+            if modifications:
+                self._apply_modifications(modifications, session)
+        elif response['status'] == 'cancelled':
+            self.append_to_chat("System", "Request cancelled.")
+        else:
+            self.append_to_chat("System", response['message'])
+
+    def _apply_modifications(self, modifications: list, session=None) -> bool:
+        session = session or self.session
+        if not session.apply_modifications(modifications):
+            return False
+        if session is self.session:
+            self._refresh_statistics()
+        return True
+
+    def _refresh_statistics(self):
+        stats = self.session.refresh_statistics()
+        if stats is not None:
+            self.update_stats_display(stats)
+    
+    def prepare_context(self, message, command) -> dict:
+        return self.session.prepare_context(message, command)
+    
+    def parse_modifications(self, response: str, command: str) -> list:
+        return self.session.parse_modifications(response, command)
+    
+    def get_document_content(self) -> str:
+        return self.session.get_document_content()
+    
+    def get_ai_response(self, context) -> dict:
+        try:
+            with self.metrics.span('llm'):
+                message = self.llm_client.complete([{"role": "user", "content": self.session.format_context(context)}])
+            return {'message': message, 'status': 'success'}
+        except Exception as e:
+            return {'message': f"Error getting AI response: {e}", 'status': 'error'}
+    
+    def append_to_chat(self, role: str, message: str):
+        self.chat_view.post(role, message)
+    
+    def save_document(self):
+        # Written by the autosave thread so the UI stays responsive on large files
+        def saved(success):
+            self.append_to_chat("System", "Document saved successfully!" if success else "Error saving document.")
+
+        if self.document_editor.has_document:
+            self.autosaver.save_now(self.document_editor, saved)
+    
+    def export_chat(self):
+        if not self.session.chat_history:
+            messagebox.showinfo("Export Chat", "No chat history to export!")
+            return
+        file_path = filedialog.asksaveasfilename(defaultextension=".txt", filetypes=[("Text files", "*.txt"), ("All files", "*.*")])
+        if file_path:
+            try:
+                with open(file_path, 'w', encoding='utf-8') as f:
+                    self.session.chat_history.export(f)
+                messagebox.showinfo("Export Chat", "Chat history exported successfully!")
+            except Exception as e:
+                messagebox.showerror("Export Error", f"Error exporting chat: {e}")
+    
+    def undo_change(self):
+        if self.session.undo():
+            self._refresh_statistics()
+            self.append_to_chat("System", "Change undone successfully!")
+        else:
+            self.append_to_chat("System", "No changes to undo.")
+    
+    def redo_change(self):
+        if self.session.redo():
+            self._refresh_statistics()
+            self.append_to_chat("System", "Change redone successfully!")
+        else:
+            self.append_to_chat("System", "No changes to redo.")
+    
+    def run(self):
+        if pythoncom:
+            pythoncom.CoInitialize()
+        self.root.mainloop()
+        if pythoncom:
+            pythoncom.CoUninitialize()
+    
+    def write_metrics(self):
+        path = os.environ.get('DOCUMENT_ASSISTANT_METRICS')
+        if self.metrics.enabled and path and path != '1':
+            try:
+                self.metrics.write(path)
+            except Exception as e:
+                logging.error(f"Error writing metrics: {e}")
+    
+    def cleanup(self):
+        try:
+            self.response_pipeline.shutdown()
+            self.autosaver.shutdown()
+            self.session_pool.shutdown()
+            self.write_metrics()
+            self.response_cache.close()
+        except Exception as e:
+            logging.error(f"Error during cleanup: {e}")
+        finally:
+            if pythoncom:
+                pythoncom.CoUninitialize()
+
+if __name__ == "__main__":
+    app = DocumentChatApp()
+    try:
+        app.run()
+    finally:
         app.cleanup()
\ No newline at end of file
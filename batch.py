@@ -0,0 +1,171 @@
+import argparse
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from app import (
+    MISTRAL_AGENT_ID, MISTRAL_API_KEY, DocumentEditor, DocumentSession, DocxBackend, MistralAgentClient
+)
+
+class RateLimiter:
+    # Spaces LLM calls at least `interval` seconds apart across every worker process.
+    # The shared state is created in the parent and inherited by the pool workers.
+    def __init__(self, requests_per_second: float):
+        self.interval = 1.0 / requests_per_second if requests_per_second > 0 else 0.0
+        self._next_slot = multiprocessing.Value('d', 0.0)
+        self._lock = multiprocessing.Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.value)
+            self._next_slot.value = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+_rate_limiter = None
+_llm_client = None
+
+def _init_worker(rate_limiter, api_key, agent_id):
+    global _rate_limiter, _llm_client
+    _rate_limiter = rate_limiter
+    _llm_client = MistralAgentClient(agent_id=agent_id, api_key=api_key) if api_key else None
+
+def expand_documents(patterns: list) -> list:
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = glob.glob(os.path.join(pattern, '**', '*.docx'), recursive=True)
+        else:
+            matches = glob.glob(pattern, recursive=True)
+        # Skip the lock files Word leaves next to open documents
+        paths.extend(path for path in sorted(matches) if not os.path.basename(path).startswith('~$'))
+    return list(dict.fromkeys(paths))
+
+def output_paths(documents: list, output_dir: str) -> dict:
+    # Mirrors each document's path below the folder the documents share, so
+    # dir/a.docx and dir/sub/a.docx get separate copies
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in documents])
+    return {path: os.path.join(output_dir, os.path.relpath(os.path.abspath(path), root)) for path in documents}
+
+def read_script(path: str) -> list:
+    with open(path, encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+
+def process_document(path: str, commands: list, output_path: str = None) -> dict:
+    timings = {}
+    result = {'path': path, 'status': 'success', 'commands': [], 'timings': timings}
+    try:
+        if output_path:
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            shutil.copyfile(path, output_path)
+            path = output_path
+            result['output'] = output_path
+
+        started = time.perf_counter()
+        # Edits are written once by the save below, so that is all the 'save' timing measures
+        session = DocumentSession(DocumentEditor(DocxBackend(), save_on_apply=False))
+        if not session.load(path):
+            raise RuntimeError("Could not open document")
+        timings['load'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        session.analyze()
+        timings['analyze'] = time.perf_counter() - started
+
+        timings['llm'] = timings['apply'] = 0.0
+        for command in commands:
+            outcome = {'command': command}
+            result['commands'].append(outcome)
+            if _llm_client is None:
+                outcome['status'] = 'skipped'
+                continue
+            messages = session.build_messages(command, command)
+            _rate_limiter.acquire()
+            started = time.perf_counter()
+            try:
+                response = _llm_client.complete(messages)
+            except Exception as e:
+                outcome.update(status='error', error=f"Error getting AI response: {e}")
+                continue
+            finally:
+                timings['llm'] += time.perf_counter() - started
+
+            session.record_turn(command, response)
+            started = time.perf_counter()
+            modifications = session.parse_modifications(response, command)
+            applied = bool(modifications) and session.apply_modifications(modifications)
+            timings['apply'] += time.perf_counter() - started
+            outcome.update(status='success', response=response, changes=len(modifications), applied=applied)
+
+        result['statistics'] = session.refresh_statistics() or session.document_analyzer.statistics
+
+        started = time.perf_counter()
+        if any(outcome.get('applied') for outcome in result['commands']):
+            session.document_editor.save()
+        session.document_editor.backend.close(save=False)
+        timings['save'] = time.perf_counter() - started
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = str(e)
+    return result
+
+def run_batch(documents: list, commands: list, output, workers: int = None, output_dir: str = None,
+              requests_per_second: float = 1.0, api_key: str = None, agent_id: str = MISTRAL_AGENT_ID) -> int:
+    failures = 0
+    rate_limiter = RateLimiter(requests_per_second)
+    targets = output_paths(documents, output_dir) if output_dir else {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(rate_limiter, api_key, agent_id)) as executor:
+        futures = [executor.submit(process_document, path, commands, targets.get(path)) for path in documents]
+        for future in as_completed(futures):
+            result = future.result()
+            failures += result['status'] != 'success'
+            output.write(json.dumps(result, default=str) + '\n')
+            output.flush()
+    return failures
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Run a script of chat commands over many .docx files without the GUI.")
+    parser.add_argument('documents', nargs='+', help="Directories, .docx files or glob patterns")
+    parser.add_argument('--script', help="Text file with one command per line; without it documents are only analyzed")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument('--output', help="JSONL results file (default: stdout)")
+    parser.add_argument('--output-dir', help="Write edited copies here, keeping their relative paths, instead of "
+                                             "editing documents in place")
+    parser.add_argument('--rate', type=float, default=1.0, help="Maximum LLM requests per second across all workers")
+    parser.add_argument('--api-key', default=os.environ.get('MISTRAL_API_KEY', MISTRAL_API_KEY))
+    parser.add_argument('--agent-id', default=MISTRAL_AGENT_ID)
+    args = parser.parse_args(argv)
+
+    documents = expand_documents(args.documents)
+    if not documents:
+        parser.error("no .docx files matched")
+    commands = read_script(args.script) if args.script else []
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+        try:
+            output_paths(documents, args.output_dir)
+        except ValueError:
+            parser.error("--output-dir needs the documents to share a common folder (e.g. the same drive)")
+    api_key = args.api_key if commands else None
+
+    output = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    try:
+        failures = run_batch(documents, commands, output, args.workers, args.output_dir, args.rate, api_key, args.agent_id)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    logging.info(f"Processed {len(documents)} documents, {failures} failed.")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
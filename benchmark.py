@@ -0,0 +1,448 @@
+import argparse
+import gc
+import io
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from datetime import datetime
+
+from docx import Document
+
+from app import DocumentAnalyzer, DocumentEditor, DocumentSession, DocxBackend, DocxStreamReader, MemoryBackend
+
+WORDS = """lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore
+et dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip ex ea
+commodo consequat duis aute irure in reprehenderit voluptate velit esse cillum fugiat nulla pariatur
+excepteur sint occaecat cupidatat non proident sunt culpa qui officia deserunt mollit anim id est laborum
+contract party agreement clause payment delivery schedule notice termination liability warranty""".split()
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# Imported on first use by app.py; importing any of them with the app is a regression
+LAZY_MODULES = ('mistralai', 'win32com', 'pythoncom', 'docx')
+STARTUP_STAGES = ('import_app', 'first_window')
+
+NAMESPACE = 'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"'
+
+def _sentence(rng: random.Random, words: int) -> str:
+    text = ' '.join(rng.choice(WORDS) for _ in range(words))
+    return text[0].upper() + text[1:] + '.'
+
+def _run_xml(rng: random.Random, text: str) -> str:
+    properties = []
+    roll = rng.random()
+    if roll < 0.15:
+        properties.append('<w:b/>')
+    elif roll < 0.25:
+        properties.append('<w:i/>')
+    elif roll < 0.3:
+        properties.append('<w:u w:val="single"/>')
+    if rng.random() < 0.1:
+        properties.append(f'<w:color w:val="{rng.randrange(0x1000000):06X}"/>')
+    if rng.random() < 0.1:
+        properties.append(f'<w:sz w:val="{rng.choice((20, 24, 28))}"/>')
+    rpr = f"<w:rPr>{''.join(properties)}</w:rPr>" if properties else ''
+    return f'<w:r>{rpr}<w:t xml:space="preserve">{text}</w:t></w:r>'
+
+def _paragraph_xml(rng: random.Random, style: str = None) -> str:
+    ppr = f'<w:pPr><w:pStyle w:val="{style}"/></w:pPr>' if style else ''
+    if style:
+        return f"<w:p>{ppr}{_run_xml(rng, _sentence(rng, rng.randint(2, 6)))}</w:p>"
+    runs = ''.join(_run_xml(rng, _sentence(rng, rng.randint(4, 14)) + ' ') for _ in range(rng.randint(1, 4)))
+    return f"<w:p>{runs}</w:p>"
+
+def _table_xml(rng: random.Random, rows: int = 3, columns: int = 3) -> str:
+    cells = ''.join(f"<w:tc>{_paragraph_xml(rng)}</w:tc>" for _ in range(columns))
+    return f"<w:tbl><w:tblPr/>{''.join(f'<w:tr>{cells}</w:tr>' for _ in range(rows))}</w:tbl>"
+
+def generate_document(path: str, paragraphs: int, seed: int = 0):
+    # Writes word/document.xml directly into python-docx's default template, which
+    # is far faster than building large documents through the python-docx API
+    rng = random.Random(seed)
+    template = io.BytesIO()
+    Document().save(template)
+    body = []
+    for index in range(paragraphs):
+        if index % 40 == 0:
+            body.append(_paragraph_xml(rng, 'Heading1'))
+        elif index % 10 == 0:
+            body.append(_paragraph_xml(rng, 'Heading2'))
+        else:
+            body.append(_paragraph_xml(rng))
+        if index % 250 == 249:
+            body.append(_table_xml(rng))
+    document_xml = (f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<w:document {NAMESPACE}><w:body>'
+                    f"{''.join(body)}<w:sectPr/></w:body></w:document>")
+    with zipfile.ZipFile(template) as source, zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as target:
+        for item in source.infolist():
+            data = document_xml.encode('utf-8') if item.filename == 'word/document.xml' else source.read(item)
+            target.writestr(item, data)
+
+def _response(changes: list) -> str:
+    return "Here are the edits.\nMODIFY_DOCUMENT\n" + json.dumps({'changes': changes}, indent=2)
+
+def _quietly(run):
+    # For stages that log a warning per missing anchor
+    def quiet(args):
+        logging.disable(logging.WARNING)
+        try:
+            return run(args)
+        finally:
+            logging.disable(logging.NOTSET)
+    return quiet
+
+def _anchored_edits(rng: random.Random, text: str, count: int) -> tuple:
+    # A response whose changes locate themselves by anchor text rather than offsets,
+    # and a command with several find targets. Anchors are phrases cut from the text,
+    # single common words with nth and negative occurrences, and a few that are absent.
+    changes = []
+    for n in range(count):
+        kind = rng.choice(('insert', 'delete', 'replace', 'format'))
+        change = {'type': kind}
+        if kind != 'delete':
+            change['text'] = rng.choice(WORDS)
+        if kind == 'format':
+            change['formatting'] = rng.choice(FORMATTING)
+        roll = rng.random()
+        if roll < 0.5:
+            start = rng.randrange(max(1, len(text) - 40))
+            change['anchor'] = text[start:start + rng.randint(12, 40)]
+        elif roll < 0.9:
+            change['anchor'] = {'text': rng.choice(WORDS), 'occurrence': rng.choice((2, 5, 20, -1, -3))}
+        else:
+            change['anchor'] = f"absent anchor {n}"
+            change['occurrence'] = rng.choice((1, -1))
+        changes.append(change)
+    command = " then ".join(f'find {occurrence} "{rng.choice(WORDS)}"' for occurrence in (1, 3, -1, -2, 10))
+    return _response(changes), command
+
+FORMATTING = ({'bold': True}, {'italic': True}, {'color': 'C00000'}, {'size': 14})
+
+def _edit_batch(rng: random.Random, total: int, count: int, formatting: bool = False) -> list:
+    changes = []
+    for _ in range(count):
+        start = rng.randrange(max(1, total - 40))
+        kind = rng.choice(('insert', 'delete', 'replace'))
+        if kind == 'insert':
+            changes.append({'type': 'insert', 'position': start, 'text': rng.choice(WORDS) + ' '})
+        else:
+            changes.append({'type': kind, 'start': start, 'end': start + rng.randint(1, 30),
+                            'text': rng.choice(WORDS)})
+        if formatting and kind != 'delete' and rng.random() < 0.3:
+            changes[-1]['formatting'] = rng.choice(FORMATTING)
+    return changes
+
+def build_cases(path: str, seed: int = 0) -> dict:
+    # Each case is (setup, run): setup builds fresh state outside the timed region
+    # and returns the argument passed to run. Shared state is built on first use, so
+    # a memory probe for one stage only holds what that stage needs.
+    state = {}
+
+    def shared(name, build):
+        if name not in state:
+            state[name] = build()
+        return state[name]
+
+    def document():
+        return shared('document', lambda: Document(path))
+
+    def reader():
+        return shared('reader', lambda: DocxStreamReader(path))
+
+    def session():
+        def build():
+            session = DocumentSession(DocumentEditor(MemoryBackend()))
+            session.load(path)
+            session.get_document_content()
+            session.document_analyzer.analyze_document(document())
+            return session
+        return shared('session', build)
+
+    def text():
+        return session().get_document_content()
+
+    def changes():
+        return shared('changes', lambda: _edit_batch(random.Random(seed), len(text()), 2000))
+
+    def formatted_changes():
+        return shared('formatted_changes', lambda: _edit_batch(random.Random(seed), len(text()), 2000, True))
+
+    def fresh_session():
+        session().invalidate_text()
+        return session()
+
+    def editor():
+        return DocumentEditor(MemoryBackend(text().split('\n')))
+
+    def docx_backend(target=path):
+        backend = DocxBackend()
+        backend.open(target)
+        backend.load()
+        return backend
+
+    def edited_copy():
+        # Saving writes the file, so it works on a copy with one edit applied
+        target = f"{path}.save.docx"
+        shutil.copyfile(path, target)
+        backend = docx_backend(target)
+        backend.apply_batch([{'type': 'insert', 'position': 0, 'text': 'Edited '}])
+        return backend
+
+    def parse_args():
+        content = text()
+        needle = content[len(content) // 2:len(content) // 2 + 24]
+        return session(), _response(changes()), f'find "{needle}"'
+
+    def undo_all(document_editor):
+        document_editor.apply_changes(changes())
+        while document_editor.undo() is not None:
+            pass
+
+    return {
+        'load_document': (lambda: path, Document),
+        'analyze_stream': (lambda: (DocumentAnalyzer(), reader()),
+                           lambda args: args[0].analyze_stream(args[1].iter_paragraphs(), args[1].style_names())),
+        'analyze_document': (lambda: (DocumentAnalyzer(), document()),
+                             lambda args: args[0].analyze_document(args[1])),
+        'analyze_document_cached': (lambda: (session().document_analyzer, document()),
+                                    lambda args: args[0].analyze_document(args[1])),
+        'get_document_content': (fresh_session, lambda s: s.get_document_content()),
+        'format_context': (session, lambda s: s.build_messages("update the payment clause", "update the payment clause")),
+        'parse_modifications': (parse_args, lambda args: args[0].parse_modifications(args[1], args[2])),
+        'parse_anchored': (lambda: (session(),) + shared('anchored', lambda: _anchored_edits(random.Random(seed), text(), 300)),
+                           _quietly(lambda args: args[0].parse_modifications(args[1], args[2]))),
+        'apply_changes': (editor, lambda document_editor: document_editor.apply_changes(changes())),
+        'apply_and_undo': (editor, undo_all),
+        'apply_changes_docx': (lambda: (docx_backend(), formatted_changes()),
+                               lambda args: args[0].apply_batch(args[1])),
+        'save_docx': (edited_copy, lambda backend: backend.save()),
+    }
+
+def measure(setup, run, repeat: int) -> dict:
+    timings = []
+    for _ in range(repeat):
+        state = setup()
+        started = time.perf_counter()
+        run(state)
+        timings.append(time.perf_counter() - started)
+    return {'median': statistics.median(timings), 'min': min(timings), 'repeat': repeat}
+
+def _max_rss() -> int:
+    # ru_maxrss on Linux also counts the peak of the process that exec'd us, so
+    # prefer the resettable high-water mark from /proc where there is one
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+def _reset_max_rss() -> bool:
+    # Linux can reset the peak to the current RSS; elsewhere the probe can only
+    # report how far the stage raised the existing peak
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def probe_peak_rss(path: str, stage: str, seed: int) -> int:
+    # Runs one stage and returns how far it raised the process's peak RSS. Unlike
+    # tracemalloc this sees lxml's C-level allocations, i.e. the XML trees.
+    setup, run = build_cases(path, seed)[stage]
+    state = setup()
+    gc.collect()
+    _reset_max_rss()
+    baseline = _max_rss()
+    run(state)
+    return _max_rss() - baseline
+
+def measure_peak_rss(path: str, stage: str, seed: int) -> int:
+    # A fresh interpreter per stage, so earlier stages cannot hide its peak
+    completed = subprocess.run([sys.executable, os.path.abspath(__file__), '--rss-probe', stage, path,
+                                '--seed', str(seed)], cwd=HERE, capture_output=True, text=True, check=True)
+    return int(completed.stdout.split()[-1])
+
+def _import_times(output: str) -> dict:
+    # Cumulative microseconds per module from `python -X importtime`
+    times = {}
+    for line in output.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            times[fields[2].strip()] = int(fields[1])
+    return times
+
+def measure_import(repeat: int, module: str = 'app') -> dict:
+    # Each run imports the module in a fresh interpreter so nothing is cached in-process.
+    # Modules the interpreter loads on its own are left out of the slowest list.
+    interpreter = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'pass'], cwd=HERE,
+                                 capture_output=True, text=True, check=True)
+    preloaded = _import_times(interpreter.stderr)
+    timings = []
+    for _ in range(repeat):
+        completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module}"], cwd=HERE,
+                                   capture_output=True, text=True, check=True)
+        times = _import_times(completed.stderr)
+        timings.append(times[module] / 1e6)
+    slowest = sorted((name for name in times if '.' not in name and name != module and name not in preloaded),
+                     key=times.get, reverse=True)
+    return {
+        'median': statistics.median(timings),
+        'min': min(timings),
+        'repeat': repeat,
+        'eager': sorted(name for name in times if name.split('.')[0] in LAZY_MODULES),
+        'slowest': [(name, times[name] / 1e6) for name in slowest[:5]]
+    }
+
+def measure_first_window(repeat: int) -> dict:
+    # Launch to first drawn frame of the GUI, which reports it and exits; needs a display
+    timings = []
+    environment = dict(os.environ, DOCUMENT_ASSISTANT_STARTUP_PROBE='1')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        completed = subprocess.run([sys.executable, os.path.join(HERE, 'app.py')], cwd=HERE, env=environment,
+                                   capture_output=True, text=True, timeout=60)
+        if 'first_window_seconds' not in completed.stdout:
+            logging.warning(f"Skipping first_window: the app did not start ({completed.stderr.strip().splitlines()[-1:]})")
+            return None
+        timings.append(time.perf_counter() - started)
+    return {'median': statistics.median(timings), 'min': min(timings), 'repeat': repeat}
+
+def run_benchmarks(sizes: list, repeat: int = 5, memory: bool = True, stages: list = None,
+                   workdir: str = None, seed: int = 0, startup: bool = False) -> dict:
+    workdir = workdir or tempfile.mkdtemp(prefix="document-benchmark-")
+    results = {}
+    for stage, measure_stage in (('import_app', measure_import), ('first_window', measure_first_window)):
+        if not startup or stages and stage not in stages:
+            continue
+        result = measure_stage(repeat)
+        if result is not None:
+            results[stage] = result
+            print(_format_row(stage, result), flush=True)
+    if stages and all(stage in STARTUP_STAGES for stage in stages):
+        sizes = []
+    for size in sizes:
+        path = os.path.join(workdir, f"synthetic-{size}-{seed}.docx")
+        if not os.path.exists(path):
+            started = time.perf_counter()
+            generate_document(path, size, seed)
+            logging.warning(f"Generated {path} in {time.perf_counter() - started:.2f}s")
+        for stage, (setup, run) in build_cases(path, seed).items():
+            if stages and stage not in stages:
+                continue
+            key = f"{stage}@{size}"
+            results[key] = measure(setup, run, repeat)
+            if memory:
+                results[key]['peak_rss_bytes'] = measure_peak_rss(path, stage, seed)
+            print(_format_row(key, results[key]), flush=True)
+    return {
+        'meta': {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': repeat,
+            'seed': seed
+        },
+        'results': results
+    }
+
+def _format_row(key: str, result: dict) -> str:
+    peak = result.get('peak_rss_bytes')
+    memory = f"{peak / 1024 / 1024:9.1f} MiB" if peak is not None else ""
+    return f"{key:<36} {result['median'] * 1000:10.2f} ms  (min {result['min'] * 1000:.2f} ms) {memory}"
+
+def compare(current: dict, baseline: dict, threshold: float) -> list:
+    # Stages whose median time or peak memory grew by more than `threshold`
+    regressions = []
+    for key, result in current['results'].items():
+        previous = baseline['results'].get(key)
+        if previous is None:
+            continue
+        for metric in ('median', 'peak_rss_bytes'):
+            if metric not in result or not previous.get(metric):
+                continue
+            ratio = result[metric] / previous[metric]
+            if ratio > 1 + threshold:
+                regressions.append((key, metric, previous[metric], result[metric], ratio))
+    return regressions
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the document hot paths on synthetic .docx files.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000],
+                        help="Paragraph counts to generate (e.g. 1000 10000 200000)")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--stage', action='append', dest='stages', help="Only run this stage (repeatable)")
+    parser.add_argument('--no-memory', action='store_true', help="Skip the per-stage peak RSS subprocesses")
+    parser.add_argument('--workdir', help="Where generated documents are kept between runs")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help="Write results to this JSON baseline file")
+    parser.add_argument('--compare', help="Baseline JSON file to compare against")
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help="Allowed relative slowdown before a stage counts as a regression")
+    parser.add_argument('--startup', action='store_true',
+                        help="Also measure importing app.py and time to the first window")
+    parser.add_argument('--import-budget', type=float,
+                        help="Fail if importing app.py takes longer than this many milliseconds")
+    parser.add_argument('--rss-probe', nargs=2, metavar=('STAGE', 'PATH'), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.rss_probe:
+        logging.getLogger().setLevel(logging.WARNING)
+        print(probe_peak_rss(args.rss_probe[1], args.rss_probe[0], args.seed))
+        return 0
+
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+    startup = args.startup or args.import_budget is not None
+    current = run_benchmarks(args.sizes, args.repeat, not args.no_memory, args.stages, args.workdir, args.seed,
+                             startup)
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(current, f, indent=2)
+    failed = False
+    if args.import_budget is not None:
+        failed = not check_import_budget(current['results'].get('import_app'), args.import_budget)
+    if not args.compare:
+        return 1 if failed else 0
+    with open(args.compare, encoding='utf-8') as f:
+        baseline = json.load(f)
+    regressions = compare(current, baseline, args.threshold)
+    for key, metric, previous, value, ratio in regressions:
+        print(f"REGRESSION {key} {metric}: {previous:.6g} -> {value:.6g} ({ratio:.2f}x)")
+    if not regressions:
+        print(f"No regressions beyond {args.threshold:.0%}")
+    return 1 if regressions or failed else 0
+
+def check_import_budget(result: dict, budget_ms: float) -> bool:
+    if result is None:
+        print("IMPORT BUDGET not checked: import_app was not measured")
+        return False
+    ok = True
+    if result['eager']:
+        print(f"IMPORT BUDGET exceeded: {', '.join(result['eager'])} imported with app.py")
+        ok = False
+    if result['median'] * 1000 > budget_ms:
+        slowest = ', '.join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in result['slowest'])
+        print(f"IMPORT BUDGET exceeded: {result['median'] * 1000:.0f} ms > {budget_ms:.0f} ms (slowest: {slowest})")
+        ok = False
+    if ok:
+        print(f"Import within budget: {result['median'] * 1000:.0f} ms <= {budget_ms:.0f} ms")
+    return ok
+
+if __name__ == "__main__":
+    sys.exit(main())